@@ -0,0 +1,328 @@
+# Created 2020 by JOANNEUM RESEARCH as part of the ATLANTIS H2020 project
+# https://www.joanneum.at
+# http://www.atlantis-ar.eu
+#
+# This tool is part of a project that has received funding from the European
+# Union's Horizon 2020 research and innovation programme under grant
+# agreement No 951900.
+
+# benchmarks of createpano and prepare_matterport on synthetic scans, which
+# do not need the Matterport3D data
+#
+# make_scan writes a scan in the layout of an extracted Matterport3D scan:
+# camera parameters of the 3 x 6 view rig with realistic poses and
+# intrinsics, color, depth and label images of the real sizes and skybox
+# faces. the benchmarks time the stages of the pipeline and whole runs
+# across output widths and worker counts and are saved as JSON, which
+# --baseline compares against an earlier result:
+#     python benchmark.py --out base.json
+#     python benchmark.py --out new.json --baseline base.json
+
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+import typing
+import statistics
+import multiprocessing
+import numpy as np
+from PIL import Image
+import cv2
+from scipy.spatial.transform import Rotation as Rot
+import createpano
+import cubemap
+import prepare_matterport
+import logging
+
+log = logging.getLogger(__name__)
+
+# bump when names or meaning of the results change
+result_version = 1
+
+# sizes of Matterport3D images
+image_size = (1280, 1024)
+face_width = 1024
+# pitch of the rig rows (radians, upwards) and the intrinsics of the views
+row_pitch = (0.52, 0.0, -0.52)
+focal_length = 1075.0
+principal_point = (629.7, 522.0)
+
+# camera to world matrix of a view as stored in the camera parameter file,
+# for a rig at position looking at yaw and pitch
+def camera_matrix(position: np.array, yaw: float, pitch: float, roll: float = 0.0) -> np.array:
+    C = np.eye(4)
+    C[:3,:3] = Rot.from_euler('xyz', [pitch + np.pi/2, roll, yaw]).as_matrix()
+    C[:3,3] = position
+    # createpano.get_angles reads the rotation from the inverse transpose
+    return np.transpose(np.linalg.inv(C))
+
+def synthetic_color(rng: np.random.Generator, h: int, w: int) -> np.array:
+    yy, xx = np.mgrid[0:h, 0:w]
+    im = np.stack([
+        128 + 100 * np.sin(xx / rng.uniform(20, 80) + rng.uniform(0, 6)),
+        128 + 100 * np.cos(yy / rng.uniform(20, 80) + rng.uniform(0, 6)),
+        np.full((h, w), rng.uniform(40, 200))
+    ], axis=2)
+    # furniture like blocks
+    for _ in range(12):
+        y0, x0 = rng.integers(0, h), rng.integers(0, w)
+        im[y0:y0 + rng.integers(20, h // 3), x0:x0 + rng.integers(20, w // 3)] = rng.uniform(0, 255, 3)
+    im += rng.normal(0, 4, im.shape)
+    return np.clip(im, 0, 255).astype(np.uint8)
+
+# depth in units of 0.25 mm as in Matterport3D, with holes
+def synthetic_depth(rng: np.random.Generator, h: int, w: int) -> np.array:
+    yy, xx = np.mgrid[0:h, 0:w]
+    depth = rng.uniform(4000, 12000) + rng.uniform(-4, 4) * xx + rng.uniform(-4, 4) * yy
+    for _ in range(6):
+        y0, x0 = rng.integers(0, h), rng.integers(0, w)
+        depth[y0:y0 + rng.integers(20, h // 3), x0:x0 + rng.integers(20, w // 3)] = rng.uniform(2000, 8000)
+    depth[rng.random((h, w)) < 0.02] = 0
+    return np.clip(depth, 0, 65535).astype(np.uint16)
+
+def synthetic_labels(rng: np.random.Generator, h: int, w: int, cell: int) -> np.array:
+    labels = rng.integers(0, 40, (h // cell + 1, w // cell + 1))
+    labels = np.repeat(np.repeat(labels, cell, axis=0), cell, axis=1)[:h, :w]
+    return np.stack([labels * 5, (labels * 7) % 256, labels * (labels % 2)], axis=2).astype(np.uint8)
+
+# write a synthetic scan to <root>/<scan_id>/<scan_id>, unless it is there
+# already, returns its location names
+def make_scan(
+    root: str,
+    scan_id: str,
+    locations: int = 2,
+    size: typing.Tuple[int, int] = image_size,
+    face: int = face_width,
+    seed: int = 0
+) -> typing.List[str]:
+    base = os.path.join(root, scan_id, scan_id)
+    conf = os.path.join(base, "undistorted_camera_parameters", scan_id + ".conf")
+    rng = np.random.default_rng(seed)
+    names = [bytes(rng.integers(0, 256, 16, dtype=np.uint8)).hex() for _ in range(locations)]
+    if os.path.exists(conf):
+        return names
+    for name, _, _, _ in prepare_matterport._CHOICE_MAPPING_.values():
+        os.makedirs(os.path.join(base, name), exist_ok=True)
+    os.makedirs(os.path.dirname(conf), exist_ok=True)
+    w, h = size
+    lines = [
+        "dataset matterport",
+        f"n_images {locations * createpano.rig_rows * createpano.rig_yaws}",
+        "depth_directory undistorted_depth_images",
+        "color_directory undistorted_color_images",
+        "default_depth_min 0.0",
+        "default_depth_max 0.0",
+        ""
+    ]
+    for location in names:
+        position = np.array([rng.uniform(-10, 10), rng.uniform(-10, 10), 1.5])
+        heading = rng.uniform(0, 2 * np.pi)
+        for row in range(createpano.rig_rows):
+            lines.append("intrinsics_matrix " + " ".join(
+                f"{x:g}" for x in (focal_length, 0, principal_point[0], 0, focal_length, principal_point[1], 0, 0, 1)
+            ))
+            for yaw in range(createpano.rig_yaws):
+                M = camera_matrix(
+                    position + rng.normal(0, 0.05, 3),
+                    heading + yaw * np.pi / 3 + rng.normal(0, 0.002),
+                    row_pitch[row] + rng.normal(0, 0.002),
+                    rng.normal(0, 0.002)
+                )
+                depth, color = f"{location}_d{row}_{yaw}.png", f"{location}_i{row}_{yaw}.jpg"
+                lines.append(f"scan {depth} {color} " + " ".join(f"{x:.9f}" for x in M.flatten()))
+                Image.fromarray(synthetic_color(rng, h, w)).save(
+                    os.path.join(base, "undistorted_color_images", color), quality=95)
+                Image.fromarray(synthetic_depth(rng, h, w)).save(
+                    os.path.join(base, "undistorted_depth_images", depth))
+                Image.fromarray(synthetic_labels(rng, h, w, 48)).save(
+                    os.path.join(base, "segmentation_maps_classes", f"{location}_c{row}_{yaw}.png"))
+                Image.fromarray(synthetic_labels(rng, h, w, 32)).save(
+                    os.path.join(base, "segmentation_maps_instances", f"{location}_i{row}_{yaw}.png"))
+        for k in range(6):
+            Image.fromarray(synthetic_color(rng, face, face)).save(
+                os.path.join(base, "matterport_skybox_images", f"{location}_skybox{k}_sami.jpg"), quality=95)
+    # written last, so that an interrupted generation is redone
+    with open(conf, 'w') as f:
+        f.write("\n".join(lines) + "\n")
+    return names
+
+# times of repeats calls of fn
+def measure(fn: typing.Callable[[], None], repeats: int) -> dict:
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return { 'median': statistics.median(times), 'min': min(times), 'times': times }
+
+def environment() -> dict:
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True,
+            cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        commit = ""
+    return {
+        'platform': platform.platform(),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'opencv': cv2.__version__,
+        'cpus': os.cpu_count(),
+        'commit': commit
+    }
+
+# benchmarks of the stages, on the first location of the scan
+def stage_benchmarks(m3d_path: str, scan_id: str, widths: typing.List[int], repeats: int) -> dict:
+    results = {}
+    out_dir = os.path.join(m3d_path, "bench_out", "stages")
+    os.makedirs(os.path.join(out_dir, "undistorted_color_images"), exist_ok=True)
+    cameras = prepare_matterport.load_scan_cameras(m3d_path, scan_id)
+    location = sorted(set(cameras['location'].tolist()))[0]
+    rig = cameras[cameras['location'] == location]
+    matrices = {}
+    for m, row, yaw in zip(rig['matrix'], rig['row'], rig['yaw']):
+        matrices.setdefault(int(row), {})[int(yaw)] = m
+    conf = os.path.join(m3d_path, scan_id, scan_id, "undistorted_camera_parameters", scan_id + ".conf")
+    results['parse_camera_params'] = measure(lambda: prepare_matterport.parse_camera_params(conf), repeats)
+    results['get_angles'] = measure(lambda: createpano.get_angles(matrices), repeats)
+    angles = createpano.get_angles(matrices)
+
+    def load(name, ext):
+        return prepare_matterport.load_location_images(m3d_path, scan_id, name, ext, location)
+    results['decode/color'] = measure(lambda: load("undistorted_color_images", "jpg"), repeats)
+    color = load("undistorted_color_images", "jpg")
+    depth = load("undistorted_depth_images", "png")
+    labels = load("segmentation_maps_classes", "png")
+    faces = load("matterport_skybox_images", "jpg")
+    results['correct_depth_distortion'] = measure(
+        lambda: [prepare_matterport.correct_depth_distortion(im) for im in depth], repeats)
+    depth = [prepare_matterport.correct_depth_distortion(im) for im in depth]
+
+    for width in widths:
+        size = (width, width // 2)
+        megapixels = width * (width // 2) / 1e6
+        view = createpano.cutout(color[0])
+        results[f'im2sphere/{width}'] = measure(lambda: createpano.im2sphere(
+            view, createpano.default_fov, size[0], size[1], angles[0,0], angles[0,1], True, 0, True), repeats)
+        # cold: including the geometry of the views, warm: with the geometry computed
+        for kind, images, blending, is_depth in (
+            ('color', color, True, False), ('depth', depth, False, True), ('labels', labels, False, False)
+        ):
+            results[f'combine_views/{kind}/{width}/cold'] = measure(lambda: createpano.combine_views(
+                images, angles, size, blending, is_depth, createpano.PanoGeometry(angles, size)), repeats)
+            geometry = createpano.PanoGeometry(angles, size)
+            createpano.combine_views(images, angles, size, blending, is_depth, geometry)
+            result = measure(lambda: createpano.combine_views(images, angles, size, blending, is_depth, geometry), repeats)
+            result['megapixels_per_s'] = megapixels / result['median']
+            results[f'combine_views/{kind}/{width}/warm'] = result
+        cubemap.combine_faces(faces, size)
+        result = measure(lambda: cubemap.combine_faces(faces, size), repeats)
+        result['megapixels_per_s'] = megapixels / result['median']
+        results[f'skybox/{width}'] = result
+        eqr = createpano.combine_views(color, angles, size, True, False, geometry)
+        results[f'encode/color/{width}'] = measure(lambda: prepare_matterport.save_panorama(
+            eqr, out_dir, "undistorted_color_images", location), repeats)
+    return results
+
+# whole runs of process_stale_units over all locations and types
+def run_benchmarks(
+    m3d_path: str,
+    scan_id: str,
+    widths: typing.List[int],
+    workers: typing.List[int],
+    types: typing.List[str],
+    repeats: int
+) -> dict:
+    results = {}
+    units = prepare_matterport.scan_units(m3d_path, scan_id, types)
+    for width in widths:
+        options = prepare_matterport.Options(m3d_path, os.path.join(m3d_path, "bench_out"), (width,))
+        for nworkers in workers:
+            pool = None
+            if nworkers > 1:
+                pool = multiprocessing.Pool(nworkers, initializer=prepare_matterport.init_worker)
+            try:
+                result = measure(lambda: prepare_matterport.process_stale_units(
+                    units, options, True, pool, len(types)), repeats)
+            finally:
+                if not(pool is None):
+                    pool.terminate()
+            result['panoramas_per_s'] = len(units) / result['median']
+            result['megapixels_per_s'] = len(units) * width * (width // 2) / 1e6 / result['median']
+            results[f'process_scan/{width}/workers{nworkers}'] = result
+    return results
+
+def compare(results: dict, baseline: dict) -> None:
+    print(f"{'benchmark':<40} {'baseline':>10} {'current':>10} {'ratio':>7}")
+    for name in sorted(set(results['results']) | set(baseline['results'])):
+        old = baseline['results'].get(name, {}).get('median')
+        new = results['results'].get(name, {}).get('median')
+        ratio = f"{new / old:7.2f}" if not(old is None or new is None) and old > 0 else "      -"
+        print(f"{name:<40} {'-' if old is None else f'{old:.4f}':>10} {'-' if new is None else f'{new:.4f}':>10} {ratio}")
+
+def parse_arguments(args):
+    parser = argparse.ArgumentParser(description="Benchmarks of the panorama pipeline on a synthetic scan")
+    parser.add_argument("--workdir", type=str, default="benchmark_data",
+        help="Directory of the synthetic scan (generated once) and the outputs"
+    )
+    parser.add_argument("--out", type=str,
+        help="JSON file to write the results to"
+    )
+    parser.add_argument("--baseline", type=str,
+        help="JSON results of an earlier run to compare with"
+    )
+    parser.add_argument("--locations", type=int, default=2,
+        help="Locations of the synthetic scan"
+    )
+    parser.add_argument("--out_width", type=int, nargs='+', default=[1024],
+        help="Output widths to benchmark"
+    )
+    parser.add_argument("--workers", type=int, nargs='+', default=[1],
+        help="Worker counts of the whole runs"
+    )
+    parser.add_argument("--types", nargs='+', default=['skybox', 'color', 'depth', 'classes', 'instances'],
+        choices=['skybox', 'color', 'depth', 'classes', 'instances'],
+        help="Types of the whole runs"
+    )
+    parser.add_argument("--repeats", type=int, default=3,
+        help="Repetitions of each benchmark, the median is compared"
+    )
+    parser.add_argument("--skip_stages", action="store_true",
+        help="Only benchmark whole runs"
+    )
+    return parser.parse_args(args)
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.WARNING)
+    args = parse_arguments(sys.argv[1:])
+    scan_id = f"SYNTH{args.locations}"
+    make_scan(args.workdir, scan_id, args.locations)
+    results = {
+        'version': result_version,
+        'environment': environment(),
+        'parameters': {
+            'locations': args.locations,
+            'out_width': args.out_width,
+            'workers': args.workers,
+            'types': args.types,
+            'repeats': args.repeats
+        },
+        'results': {}
+    }
+    if not args.skip_stages:
+        results['results'].update(stage_benchmarks(args.workdir, scan_id, args.out_width, args.repeats))
+    results['results'].update(run_benchmarks(args.workdir, scan_id, args.out_width, args.workers, args.types, args.repeats))
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(results, f, indent=1, sort_keys=True)
+    if args.baseline:
+        with open(args.baseline, 'r') as f:
+            baseline = json.load(f)
+        if baseline.get('version') != result_version:
+            log.warning(f"{args.baseline} has results of another version")
+        compare(results, baseline)
+    else:
+        for name, result in sorted(results['results'].items()):
+            print(f"{name:<40} {result['median']:10.4f} s")
@@ -0,0 +1,149 @@
+# Created 2020 by JOANNEUM RESEARCH as part of the ATLANTIS H2020 project
+# https://www.joanneum.at
+# http://www.atlantis-ar.eu
+#
+# This tool is part of a project that has received funding from the European
+# Union's Horizon 2020 research and innovation programme under grant
+# agreement No 951900.
+
+# memory budget of a run: tasks with an estimate of their peak memory are
+# started in a pool of worker processes only while the tasks in progress fit
+# the budget together, see imap_budgeted
+#
+# the memory a task actually needed is measured in the worker as its peak
+# resident set size over the resident size of the idle worker (VmHWM and
+# VmRSS, the peak being reset through /proc/self/clear_refs, Linux only), so
+# that the estimates can be reported against it, see measured and Usage
+
+import ctypes
+import ctypes.util
+import queue
+import typing
+import logging
+
+log = logging.getLogger(__name__)
+
+# a field of /proc/self/status in bytes, None where not available
+def _status(field: str) -> typing.Optional[int]:
+    try:
+        with open("/proc/self/status", 'r') as f:
+            for line in f:
+                if line.startswith(field + ":"):
+                    return int(line.split()[1]) << 10
+    except OSError:
+        pass
+    return None
+
+def rss() -> typing.Optional[int]:
+    return _status("VmRSS")
+
+def peak_rss() -> typing.Optional[int]:
+    return _status("VmHWM")
+
+# reset the peak resident set size to the current one
+def reset_peak() -> bool:
+    try:
+        with open("/proc/self/clear_refs", 'w') as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+# return memory freed by the allocator to the system (glibc only), which
+# otherwise keeps it for later allocations of the process
+def release_memory() -> None:
+    global _malloc_trim
+    if _malloc_trim is None:
+        try:
+            _malloc_trim = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6").malloc_trim
+        except (OSError, AttributeError):
+            _malloc_trim = False
+    if _malloc_trim:
+        _malloc_trim(0)
+
+_malloc_trim = None
+
+# resident size of this process before its first measured task
+_baseline = None
+
+# fn(*args, **kwargs) and the memory the process needed while running it on
+# top of its resident size before the first task, None where it cannot be
+# measured. memory freed by earlier tasks but kept by the allocator counts,
+# as it does towards the memory of the machine
+def measured(fn: typing.Callable, *args, **kwargs) -> typing.Tuple[typing.Any, typing.Optional[int]]:
+    global _baseline
+    if _baseline is None:
+        _baseline = rss()
+    if _baseline is None or not reset_peak():
+        return fn(*args, **kwargs), None
+    result = fn(*args, **kwargs)
+    peak = peak_rss()
+    if peak is None:
+        return result, None
+    return result, max(0, peak - _baseline)
+
+# fn of each task in the pool, at most processes at a time and, beyond the
+# first, only while the estimates of the tasks in progress add up to at most
+# limit bytes, so a task exceeding it runs alone. tasks are started in order,
+# results are yielded as the tasks finish
+def imap_budgeted(
+    pool,
+    fn: typing.Callable,
+    tasks: typing.Iterable,
+    estimates: typing.Iterable[int],
+    limit: int,
+    processes: int
+):
+    pending = list(zip(tasks, estimates))
+    finished = queue.Queue()
+    next_task = 0
+    running = 0
+    in_use = 0
+    while next_task < len(pending) or running > 0:
+        while next_task < len(pending) and running < processes and (
+            running == 0 or in_use + pending[next_task][1] <= limit
+        ):
+            task, estimate = pending[next_task]
+            pool.apply_async(
+                fn, (task,),
+                callback=lambda result, estimate=estimate: finished.put((estimate, result, None)),
+                error_callback=lambda error, estimate=estimate: finished.put((estimate, None, error))
+            )
+            next_task += 1
+            running += 1
+            in_use += estimate
+        estimate, result, error = finished.get()
+        running -= 1
+        in_use -= estimate
+        if not(error is None):
+            raise error
+        yield result
+
+# estimated and measured memory of the tasks of a run, by key (e.g. type)
+class Usage:
+    def __init__(self):
+        self.records = {}
+
+    def add(self, key: str, estimate: int, observed: typing.Optional[int]) -> None:
+        if not(observed is None):
+            self.records.setdefault(key, []).append((estimate, observed))
+
+    # per key the number of tasks, mean estimate and observation in MB and
+    # the largest ratio of observation to estimate
+    def summary(self) -> dict:
+        summary = {}
+        for key, records in sorted(self.records.items()):
+            summary[key] = {
+                'count': len(records),
+                'estimate_mb': sum(e for e, _ in records) / len(records) / 2**20,
+                'observed_mb': sum(o for _, o in records) / len(records) / 2**20,
+                'max_ratio': max(o / e for e, o in records if e > 0) if any(e > 0 for e, _ in records) else 0.0
+            }
+        return summary
+
+    def report(self) -> None:
+        for key, entry in self.summary().items():
+            log.info(f"{key}: {entry['count']} units, estimated {entry['estimate_mb']:.0f} MB, "
+                f"observed {entry['observed_mb']:.0f} MB (up to {entry['max_ratio']:.2f} of the estimate)")
+            if entry['max_ratio'] > 1.25:
+                log.warning(f"{key}: units needed up to {entry['max_ratio']:.2f} times their memory estimate")
@@ -9,6 +9,7 @@
 # ported and extended code from https://github.com/yindaz/PanoBasic
 
 import typing
+import functools
 import numpy as np
 from numpy.linalg import inv
 import math
@@ -18,129 +19,580 @@ from scipy.spatial.transform import Rotation as Rot
 from scipy.ndimage import *
 import cv2
 from PIL import Image
+import profiling
 
 # definitions following PanoBasic
+# views of the Matterport rig: 3 camera rows with 6 yaw positions each
+rig_rows = 3
+rig_yaws = 6
 refview = (1,3)
 imcutout = [[0,1013],[0,1254]]
 default_fov = 1.06
+# largest reduction of source images decoded at a smaller size, see decode_factor
+max_decode_factor = 8
 
 # adjustment to match Matterport Skybox
 xoffset = math.pi / 3.0  # 60 degs
 
+# border samples per image edge and safety margin in pixels for view footprints
+footprint_samples = 64
+footprint_margin = 2
+
+# image types cv2.remap handles natively
+remap_dtypes = (np.uint8, np.uint16, np.int16, np.float32, np.float64)
+
+# source coordinate for panorama pixels outside of a view in fixed point maps,
+# far enough outside to sample the border only
+fixed_point_outside = -64.0
+
 # get hor/vert angles for each view, starting from Matterport matrices (inverse of extrinsic)
 def get_angles(matrixDict) -> np.array:
-    v = np.zeros((18,2))
+    matrices = np.array([
+        matrixDict[row][yaw] for row in range(rig_rows) for yaw in range(rig_yaws)
+    ])
+    return get_angles_batch(matrices[np.newaxis])[0]
+
+# get_angles for many locations at once, matrices of shape (locations, 18, 4, 4)
+# with the views of a location ordered by row and yaw
+def get_angles_batch(matrices: np.array) -> np.array:
     rot_ctor = Rot.from_matrix\
         if version.parse(scipy.__version__) >= version.parse('1.4.0')\
         else Rot.from_dcm
-    euler = np.array([ 
-        rot_ctor(inv(np.transpose(matrixDict[0][0]))[0:3,0:3]).as_euler('xyz'),
-        rot_ctor(inv(np.transpose(matrixDict[0][1]))[0:3,0:3]).as_euler('xyz'),
-        rot_ctor(inv(np.transpose(matrixDict[0][2]))[0:3,0:3]).as_euler('xyz'),
-        rot_ctor(inv(np.transpose(matrixDict[0][3]))[0:3,0:3]).as_euler('xyz'),
-        rot_ctor(inv(np.transpose(matrixDict[0][4]))[0:3,0:3]).as_euler('xyz'),
-        rot_ctor(inv(np.transpose(matrixDict[0][5]))[0:3,0:3]).as_euler('xyz'),
-        rot_ctor(inv(np.transpose(matrixDict[1][0]))[0:3,0:3]).as_euler('xyz'),
-        rot_ctor(inv(np.transpose(matrixDict[1][1]))[0:3,0:3]).as_euler('xyz'),
-        rot_ctor(inv(np.transpose(matrixDict[1][2]))[0:3,0:3]).as_euler('xyz'),
-        rot_ctor(inv(np.transpose(matrixDict[1][3]))[0:3,0:3]).as_euler('xyz'),
-        rot_ctor(inv(np.transpose(matrixDict[1][4]))[0:3,0:3]).as_euler('xyz'),
-        rot_ctor(inv(np.transpose(matrixDict[1][5]))[0:3,0:3]).as_euler('xyz'),
-        rot_ctor(inv(np.transpose(matrixDict[2][0]))[0:3,0:3]).as_euler('xyz'),
-        rot_ctor(inv(np.transpose(matrixDict[2][1]))[0:3,0:3]).as_euler('xyz'),
-        rot_ctor(inv(np.transpose(matrixDict[2][2]))[0:3,0:3]).as_euler('xyz'),
-        rot_ctor(inv(np.transpose(matrixDict[2][3]))[0:3,0:3]).as_euler('xyz'),
-        rot_ctor(inv(np.transpose(matrixDict[2][4]))[0:3,0:3]).as_euler('xyz'),
-        rot_ctor(inv(np.transpose(matrixDict[2][5]))[0:3,0:3]).as_euler('xyz') 
-    ])
-    step = 6
-    for i in range(3):
-        v[i * step:(i+1) * step, 0] = np.array([
-            euler[refview[0]*step+refview[1],2] - euler[i*step+0,2],
-            euler[refview[0]*step+refview[1],2] - euler[i*step+1,2],
-            euler[refview[0]*step+refview[1],2] - euler[i*step+2,2],
-            euler[refview[0]*step+refview[1],2] - euler[i*step+3,2],
-            euler[refview[0]*step+refview[1],2] - euler[i*step+4,2],
-            euler[refview[0]*step+refview[1],2] - euler[i*step+5,2] 
-        ])
-        v[i * step: (i+1) * step, 1] = np.array([
-            euler[refview[0]*step+refview[1],0] - euler[i*step+0,0],
-            euler[refview[0]*step+refview[1],0] - euler[i*step+1,0],
-            euler[refview[0]*step+refview[1],0] - euler[i*step+2,0],
-            euler[refview[0]*step+refview[1],0] - euler[i*step+3,0],
-            euler[refview[0]*step+refview[1],0] - euler[i*step+4,0],
-            euler[refview[0]*step+refview[1],0] - euler[i*step+5,0] 
-        ])
-    v[:, 0] = v[:, 0] + xoffset
+    nlocations = matrices.shape[0]
+    nviews = rig_rows * rig_yaws
+    rotations = inv(np.swapaxes(matrices, -1, -2))[..., 0:3, 0:3]
+    euler = np.reshape(
+        rot_ctor(np.reshape(rotations, (-1, 3, 3))).as_euler('xyz'),
+        (nlocations, nviews, 3)
+    )
+    ref = euler[:, refview[0]*rig_yaws+refview[1], np.newaxis, :]
+    v = np.stack([ref[:,:,2] - euler[:,:,2], ref[:,:,0] - euler[:,:,0]], axis=2)
+    v[:, :, 0] = v[:, :, 0] + xoffset
     v[v > math.pi] -= 2 * math.pi        
-    v[:, 1] = -v[:, 1]
+    v[:, :, 1] = -v[:, :, 1]
     return v
 
-# set blending false for label maps
+# remap geometry of a single source view onto the panorama
+class ViewGeometry(typing.NamedTuple):
+    mapx: np.array      # float32 remap coordinates into the cropped source,
+    mapy: np.array      # or fixed point maps, see fixed_point_view
+    crop: typing.Tuple[int, int, int, int]  # source crop (minY, maxY, minX, maxX)
+    valid: np.array     # panorama pixels that sample inside the crop, in front of the view
+    window: typing.Tuple[int, int, int, int]  # panorama area of the maps, see view_footprint
+
+# stitching geometry of one location, independent of the image modality
+# views are computed on first use and shared by color, depth and label maps
+# with a store (see remapstore.RemapStore), the view angles are quantized and
+# the tables are looked up in / added to the store, shared across locations
+# with fixed_point, views are kept as fixed point maps, which are specific to
+# the interpolation (see fixed_point_view)
+class PanoGeometry:
+    def __init__(
+        self,
+        v: np.array,
+        outsize: typing.Tuple[int, int],
+        imHoriFOV: float = default_fov,
+        store = None,
+        fixed_point: bool = False
+    ):
+        self.v = v
+        self.outsize = tuple(outsize)
+        self.imHoriFOV = imHoriFOV
+        self.store = store
+        self.fixed_point = fixed_point
+        self._views = {}
+        self._lookups = {}
+
+    def view(self, nr: int, imshape: typing.Tuple[int, int], interpolate: bool = True) -> ViewGeometry:
+        key = self._view_key(nr, imshape, interpolate)
+        if not(key in self._views):
+            with profiling.stage("geometry"):
+                if self.store is None:
+                    view = view_geometry(
+                        imshape,
+                        self.imHoriFOV,
+                        self.outsize[0],
+                        self.outsize[1],
+                        self.v[nr,0],
+                        self.v[nr,1]
+                    )
+                    if self.fixed_point:
+                        view = fixed_point_view(view, interpolate)
+                    self._views[key] = view
+                else:
+                    self._views[key] = self._stored_view(nr, imshape, interpolate)
+        return self._views[key]
+
+    # see view_lookup, shared by class and instance maps
+    def lookup(self, imshape: typing.Tuple[int, int], views: typing.List[int]) -> np.array:
+        key = (imshape[0], imshape[1], tuple(views))
+        if not(key in self._lookups):
+            self._lookups[key] = view_lookup(self, imshape, views)
+        return self._lookups[key]
+
+    # see lookup_index, for images stacked as in stack_views
+    def lookup_index(
+        self,
+        imshape: typing.Tuple[int, int],
+        stackshape: typing.Tuple[int, ...],
+        views: typing.List[int]
+    ) -> np.array:
+        key = (imshape[0], imshape[1], tuple(views), tuple(stackshape))
+        if not(key in self._lookups):
+            # only the index is kept, the lookup is cached when it is saved
+            self._lookups[key] = lookup_index(view_lookup(self, imshape, views), stackshape)
+        return self._lookups[key]
+
+    # rows (row0, row1) of a view, None if the view does not reach into them
+    # views that are cached or stored are sliced, others are computed for the
+    # rows only and not kept, see combine_views_tiled
+    def tile_view(
+        self,
+        nr: int,
+        imshape: typing.Tuple[int, int],
+        rows: typing.Tuple[int, int],
+        interpolate: bool = True
+    ) -> ViewGeometry:
+        if self._view_key(nr, imshape, interpolate) in self._views or not(self.store is None):
+            return slice_view(self.view(nr, imshape, interpolate), rows)
+        with profiling.stage("geometry"):
+            view = view_geometry(
+                imshape,
+                self.imHoriFOV,
+                self.outsize[0],
+                self.outsize[1],
+                self.v[nr,0],
+                self.v[nr,1],
+                rows
+            )
+            if self.fixed_point and not(view is None):
+                view = fixed_point_view(view, interpolate)
+        return view
+
+    # memory of the views and lookups computed so far
+    def nbytes(self) -> int:
+        arrays = list(self._lookups.values())
+        for view in self._views.values():
+            arrays.extend(a for a in (view.mapx, view.mapy, view.valid) if not(a is None))
+        return int(np.sum([a.nbytes for a in arrays], dtype=np.int64))
+
+    # float maps serve both interpolations
+    def _view_key(self, nr: int, imshape: typing.Tuple[int, int], interpolate: bool):
+        return (nr, imshape[0], imshape[1], interpolate if self.fixed_point else None)
+
+    def _stored_view(self, nr: int, imshape: typing.Tuple[int, int], interpolate: bool) -> ViewGeometry:
+        x = self.store.quantize(self.v[nr,0])
+        y = self.store.quantize(self.v[nr,1])
+        storekey = self.store.key(
+            x, y,
+            self.imHoriFOV,
+            tuple(map(tuple, imcutout)),
+            (imshape[0], imshape[1]),
+            self.outsize,
+            ('fixed', interpolate) if self.fixed_point else 'float'
+        )
+        tables = self.store.get(storekey)
+        if tables is None:
+            geometry = view_geometry(imshape, self.imHoriFOV, self.outsize[0], self.outsize[1], x, y)
+            if self.fixed_point:
+                geometry = fixed_point_view(geometry, interpolate)
+            tables = {
+                'mapx': geometry.mapx,
+                'crop': np.array(geometry.crop),
+                'valid': geometry.valid,
+                'window': np.array(geometry.window)
+            }
+            # nearest neighbour fixed point maps have no interpolation table
+            if not(geometry.mapy is None):
+                tables['mapy'] = geometry.mapy
+            tables = self.store.put(storekey, tables)
+        return ViewGeometry(
+            tables['mapx'],
+            tables.get('mapy'),
+            tuple(int(c) for c in tables['crop']),
+            tables['valid'],
+            tuple(int(w) for w in tables['window'])
+        )
+
+# set blending false for label maps, which are composed with view_lookup
+# low_memory accumulates in float32 instead of float64
 def combine_views(
     images: typing.List[np.array],
     v: np.array,
     outsize: typing.Tuple[int, int],
     blending: bool=True,
-    depth: bool=False
+    depth: bool=False,
+    geometry: PanoGeometry=None,
+    low_memory: bool=False
 ):
+    if geometry is None:
+        geometry = PanoGeometry(v, outsize)
+    if not(blending or depth):
+        return compose_labels(images, geometry)
     nchannels = images[0].shape[2]
-    pano = np.zeros((outsize[1],outsize[0],nchannels))
-    pano_w = np.zeros((outsize[1],outsize[0],nchannels))
+    dtype = np.float32 if low_memory else np.float64
+    pano = np.zeros((outsize[1],outsize[0],nchannels), dtype)
+    # weights are the same for all channels
+    pano_w = np.zeros((outsize[1],outsize[0]), dtype)
     for i in range(len(images)):
         if images[i].size < 3:
             continue
-        sphere_img, validMap = im2sphere(
-            images[i][imcutout[0][0]:imcutout[0][1],imcutout[1][0]:imcutout[1][1]],
-            default_fov, 
-            outsize[0], 
-            outsize[1], 
-            v[i,0], 
-            v[i,1], 
-            blending,
-            i,
-            depth
-        )         
-        sphere_img[validMap<0.00000001] = 0
+        im = cutout(images[i])
+        accumulate_view(pano, pano_w, 0, im, geometry.view(i, im.shape, blending), blending, depth)
+    normalize_pano(pano, pano_w)
+    return pano
+
+# combine_views in horizontal strips of at most tile_height rows, yields
+# (first row, strip) per strip. only the views overlapping a strip are
+# processed for it, so memory is bounded by the strip size.
+# for label maps, on_lookup is called with the first row and the lookup of
+# each strip before it is yielded, see images_view_lookup
+def combine_views_tiled(
+    images: typing.List[np.array],
+    v: np.array,
+    outsize: typing.Tuple[int, int],
+    tile_height: int,
+    blending: bool=True,
+    depth: bool=False,
+    geometry: PanoGeometry=None,
+    low_memory: bool=False,
+    on_lookup: typing.Callable[[int, np.array], None]=None
+):
+    if geometry is None:
+        geometry = PanoGeometry(v, outsize)
+    views, imshape = available_views(images)
+    if not(blending or depth):
+        stacked = stack_views(images)
+    nchannels = images[views[0]].shape[2]
+    dtype = np.float32 if low_memory else np.float64
+    for row0 in range(0, outsize[1], tile_height):
+        row1 = min(outsize[1], row0 + tile_height)
+        if not(blending or depth):
+            lookup = view_lookup(geometry, imshape, views, (row0, row1))
+            index = lookup_index(lookup, stacked.shape)
+            if not(on_lookup is None):
+                with profiling.stage("view_lookup"):
+                    strip_lookup = label_lookup(lookup, stacked, index)
+                on_lookup(row0, strip_lookup)
+            yield row0, gather_labels(stacked, index)
+            continue
+        pano = np.zeros((row1 - row0,outsize[0],nchannels), dtype)
+        pano_w = np.zeros((row1 - row0,outsize[0]), dtype)
+        for i in views:
+            view = geometry.tile_view(i, imshape, (row0, row1), blending)
+            if view is None:
+                continue
+            im = cutout(images[i])
+            accumulate_view(pano, pano_w, row0, im, view, blending, depth)
+        normalize_pano(pano, pano_w)
+        yield row0, pano
+
+# add a view to the panorama (part) pano starting at row0, in place
+def accumulate_view(
+    pano: np.array,
+    pano_w: np.array,
+    row0: int,
+    im: np.array,
+    view: ViewGeometry,
+    blending: bool,
+    depth: bool
+) -> None:
+    # only the footprint of the view on the panorama is processed
+    sphere_img, validMap = project_view(im, view, blending, depth)
+    sphere_img[validMap<0.00000001] = 0
+    rows = slice(view.window[0] - row0, view.window[1] - row0)
+    for cols, wcols in window_slices(view.window, pano.shape[1]):
+        tile = pano[rows,cols]
+        tile_img = sphere_img[:,wcols]
         if blending:
-            pano = pano + sphere_img
+            tile += tile_img
         else:
-            if depth:
-                sphere_img[:,:,0] = sphere_img[:,:,0] * validMap
-                pano = pano + sphere_img 
+            tile[:,:,0] += tile_img[:,:,0] * validMap[:,wcols]
+        pano_w[rows,cols] += validMap[:,wcols]
 
+# divide the accumulated panorama by the accumulated weights, in place
+def normalize_pano(pano: np.array, pano_w: np.array) -> None:
+    # pixels without any weight have not been written to and stay 0
+    covered = (pano_w != 0)[:,:,np.newaxis]
+    np.divide(pano, pano_w[:,:,np.newaxis], out=pano, where=covered)
+
+# per panorama pixel the source view index and the nearest source column and
+# row in the uncropped image, -1 where no view is visible, in layers of shape
+# (layers, rows, columns, 3). where views overlap the last one is in layer 0,
+# the one before it in layer 1 and so on, so that labels can fall through to
+# earlier views where a view has none, as when warping them one after the other
+# (see gather_labels). with rows = (row0, row1) only these rows of the panorama
+# are returned
+def view_lookup(
+    geometry: PanoGeometry,
+    imshape: typing.Tuple[int, int],
+    views: typing.List[int],
+    rows: typing.Tuple[int, int] = None
+) -> np.array:
+    if rows is None:
+        rows = (0, geometry.outsize[1])
+    lookup = np.full((1, rows[1] - rows[0], geometry.outsize[0], 3), -1, np.int16)
+    for i in views:
+        if rows == (0, geometry.outsize[1]):
+            view = geometry.view(i, imshape, False)
+        else:
+            view = geometry.tile_view(i, imshape, rows, False)
+            if view is None:
+                continue
+        minY, _, minX, _ = view.crop
+        x, y = nearest_coordinates(view)
+        entry = np.stack([
+            np.full(view.valid.shape, i, np.int16),
+            (np.where(view.valid, x, 0) + minX + imcutout[1][0]).astype(np.int16),
+            (np.where(view.valid, y, 0) + minY + imcutout[0][0]).astype(np.int16)
+        ], axis=2)
+        lookup_rows = slice(view.window[0] - rows[0], view.window[1] - rows[0])
+        for cols, wcols in window_slices(view.window, geometry.outsize[0]):
+            valid = view.valid[:,wcols]
+            if np.any(valid & (lookup[-1,lookup_rows,cols,0] >= 0)):
+                lookup = np.concatenate([lookup, np.full((1,) + lookup.shape[1:], -1, np.int16)])
+            layers = lookup[:,lookup_rows,cols]
+            # the views below move down by one layer
+            np.copyto(layers[1:], layers[:-1].copy(), where=valid[np.newaxis,:,:,np.newaxis])
+            np.copyto(layers[0], entry[:,wcols], where=valid[:,:,np.newaxis])
+    return lookup
+
+# the lookup as flat pixel indices into the stacked source images, where
+# uncovered pixels point to the blank image at the end, see stack_views
+def lookup_index(lookup: np.array, stackshape: typing.Tuple[int, ...]) -> np.array:
+    size = stackshape[0] * stackshape[1] * stackshape[2]
+    index = np.empty(lookup.shape[:-1], np.int32 if size < 2**31 else np.int64)
+    # layer by layer, which bounds the int64 intermediates
+    for layer, layer_index in zip(lookup, index):
+        views = layer[:,:,0].astype(np.int64)
+        layer_index[...] = (views * stackshape[1] + layer[:,:,2]) * stackshape[2] + layer[:,:,1]
+        layer_index[views < 0] = (stackshape[0] - 1) * stackshape[1] * stackshape[2]
+    return index
+
+# views present in images, and the shape of their crops
+def available_views(images: typing.List[np.array]):
+    views = [i for i in range(len(images)) if images[i].size >= 3]
+    imshape = cutout(images[views[0]]).shape
+    return views, imshape
+
+# imcutout of a source image, or of one decoded at 1/factor of its size. the
+# crop is then rounded up to whole pixels, views of its shape are computed
+# for the full size crop and converted to the reduced pixels, see
+# view_geometry. the cutout of a scaled cutout is the image itself
+def cutout(im: np.array, factor: int = 1) -> np.array:
+    return im[
+        imcutout[0][0] // factor:-(-imcutout[0][1] // factor),
+        imcutout[1][0] // factor:-(-imcutout[1][1] // factor)
+    ]
+
+# shape of the cutout of a source image decoded at 1/factor of its size
+def cutout_shape(factor: int = 1) -> typing.Tuple[int, int]:
+    return (
+        -(-imcutout[0][1] // factor) - imcutout[0][0] // factor,
+        -(-imcutout[1][1] // factor) - imcutout[1][0] // factor
+    )
+
+# factor by which the source images with cutouts of imshape were reduced, 1
+# for full size images and other shapes
+def cutout_factor(imshape: typing.Tuple[int, int]) -> int:
+    factor = 2
+    while factor <= max_decode_factor:
+        if tuple(imshape[:2]) == cutout_shape(factor):
+            return factor
+        factor *= 2
+    return 1
+
+# largest power of two by which source views of width imW can be reduced
+# before warping them onto a panorama of width sphereW without undersampling
+# it, i.e. while the scaled source pixels at the view center still subtend at
+# most one panorama pixel
+def decode_factor(sphereW: int, imW: int, imHoriFOV: float = default_fov) -> int:
+    # source pixels per radian at the view center
+    R = ((min(imW, imcutout[1][1]) - imcutout[1][0]) / 2) / math.tan(imHoriFOV / 2)
+    factor = 1
+    while factor < max_decode_factor and R / (factor * 2) >= sphereW / (2 * math.pi):
+        factor *= 2
+    return factor
+
+# per panorama pixel the source view index, column and row its label is
+# taken from, -1 where no view is visible, see view_lookup. for labels with
+# several channels the last view with any nonzero channel
+def images_view_lookup(
+    images: typing.List[np.array],
+    geometry: PanoGeometry,
+    rows: typing.Tuple[int, int] = None
+) -> np.array:
+    views, imshape = available_views(images)
+    if rows is None:
+        layers = geometry.lookup(imshape, views)
+    else:
+        layers = view_lookup(geometry, imshape, views, rows)
+    stacked = stack_views(images)
+    return label_lookup(layers, stacked, lookup_index(layers, stacked.shape))
+
+# images_view_lookup from the layers of view_lookup, the stacked views and
+# the index of the layers into them
+def label_lookup(layers: np.array, stacked: np.array, index: np.array) -> np.array:
+    flat = np.reshape(stacked, (-1, stacked.shape[3]))
+    blank = flat.shape[0] - stacked.shape[1] * stacked.shape[2]
+    lookup = layers[0].copy()
+    void = ~np.any(np.take(flat, index[0], axis=0), axis=2)
+    for layer, layer_index in zip(layers[1:], index[1:]):
+        rows, cols = np.nonzero(void & (layer_index != blank))
+        if len(rows) == 0:
+            break
+        labeled = np.any(np.take(flat, layer_index[rows,cols], axis=0), axis=1)
+        rows, cols = rows[labeled], cols[labeled]
+        lookup[rows,cols] = layer[rows,cols]
+        void[rows,cols] = False
+    return lookup
+
+# all source images in one array, missing views and one extra image blank
+def stack_views(images: typing.List[np.array]) -> np.array:
+    views, _ = available_views(images)
+    blank = np.zeros_like(images[views[0]])
+    return np.stack([images[i] if images[i].size >= 3 else blank for i in range(len(images))] + [blank])
+
+# nearest neighbour gather of the panorama pixels from the stacked views, the
+# index in layers as from lookup_index(view_lookup). labels that are 0 are
+# taken from the view below, as later views only overwrite nonzero labels
+def gather_labels(stacked: np.array, index: np.array) -> np.array:
+    flat = np.reshape(stacked, (-1, stacked.shape[3]))
+    labels = np.take(flat, index[0], axis=0)
+    blank = flat.shape[0] - stacked.shape[1] * stacked.shape[2]
+    for layer in index[1:]:
+        rows, cols = np.nonzero(np.any(labels == 0, axis=2) & (layer != blank))
+        if len(rows) == 0:
+            break
+        current = labels[rows,cols]
+        labels[rows,cols] = np.where(current == 0, np.take(flat, layer[rows,cols], axis=0), current)
+    return labels
+
+# label panorama by a nearest neighbour gather from the stacked views
+def compose_labels(
+    images: typing.List[np.array],
+    geometry: PanoGeometry
+) -> np.array:
+    views, imshape = available_views(images)
+    stacked = stack_views(images)
+    return gather_labels(stacked, geometry.lookup_index(imshape, stacked.shape, views))
+
+# bounding window (row0, row1, col0, ncols) of a view on the equirectangular grid
+# columns continue across the seam, i.e. are taken modulo sphereW
+def view_footprint(
+    imshape: typing.Tuple[int, int],
+    imHoriFOV: float,
+    sphereW: int,
+    sphereH: int,
+    x: float,
+    y: float
+) -> typing.Tuple[int, int, int, int]:
+    imH = imshape[0]
+    imW = imshape[1]
+    R = (imW/2) / math.tan(imHoriFOV/2)
+    # tangent plane of the view and its axes, as in view_geometry
+    center = np.array([R * math.cos(y) * math.sin(x), R * math.cos(y) * math.cos(x), R * math.sin(y)])
+    vecposX = np.array([math.cos(x), -math.sin(x), 0])
+    vecposY = np.cross(center, vecposX)
+    vecposY = vecposY / np.linalg.norm(vecposY)
+    # extent of the plane that can be sampled, see valid_map
+    dX = (-(imW+1)/2, imW - 2 - (imW+1)/2)
+    dY = (-(imH+1)/2, imH - 2 - (imH+1)/2)
+    # directions along the border of the sampled extent
+    t = np.linspace(0, 1, footprint_samples)
+    bX = np.concatenate([dX[0] + t*(dX[1]-dX[0]), np.full_like(t, dX[1]), dX[1] - t*(dX[1]-dX[0]), np.full_like(t, dX[0])])
+    bY = np.concatenate([np.full_like(t, dY[0]), dY[0] + t*(dY[1]-dY[0]), np.full_like(t, dY[1]), dY[1] - t*(dY[1]-dY[0])])
+    P = center + np.outer(bX, vecposX) + np.outer(bY, vecposY)
+    ANGx = np.arctan2(P[:,0], P[:,1])
+    ANGy = np.arctan2(P[:,2], np.hypot(P[:,0], P[:,1]))
+    # inverse of the pixel to angle mapping in view_geometry
+    TY = (sphereH / 2) + 0.5 - ANGy / math.pi * sphereH
+    row0 = max(0, math.floor(TY.min()) - footprint_margin)
+    row1 = min(sphereH, math.ceil(TY.max()) + footprint_margin + 1)
+    # a pole inside the view covers all columns up to the border of the panorama
+    for pole in (1, -1):
+        if pole * center[2] <= 0:
+            continue
+        poleY = np.dot(vecposY, np.array([0, 0, R * R / center[2]]) - center)
+        if dY[0] <= poleY <= dY[1]:
+            if pole > 0:
+                row0 = 0
             else:
-                pano[sphere_img>0] = sphere_img[sphere_img>0] 
-        pano_w[:,:,0] = pano_w[:,:,0] + validMap
-        if nchannels>1:
-            pano_w[:,:,1] = pano_w[:,:,1] + validMap
-            pano_w[:,:,2] = pano_w[:,:,2] + validMap
-    pano[pano_w==0] = 0
-    pano_w[pano_w==0] = 1
-    if blending or depth:
-        pano = np.divide(pano, pano_w)
-    return pano
+                row1 = sphereH
+            return (row0, row1, 0, sphereW)
+    # close to a pole the border of the view may pass it on either side, where
+    # the longitudes relative to the view center are ambiguous
+    if row0 == 0 or row1 == sphereH:
+        return (row0, row1, 0, sphereW)
+    # longitudes relative to the view center do not jump at the seam
+    dANGx = np.mod(ANGx - x + math.pi, 2 * math.pi) - math.pi
+    TX0 = (x + dANGx.min()) / (2 * math.pi) * sphereW + (sphereW / 2) + 0.5
+    TX1 = (x + dANGx.max()) / (2 * math.pi) * sphereW + (sphereW / 2) + 0.5
+    col0 = math.floor(TX0) - footprint_margin
+    ncols = math.ceil(TX1) + footprint_margin + 1 - col0
+    if ncols >= sphereW:
+        return (row0, row1, 0, sphereW)
+    return (row0, row1, col0 % sphereW, ncols)
 
-def im2sphere(
-    im: np.array,
+# column slices of a window in the panorama and in the window, split at the seam
+def window_slices(
+    window: typing.Tuple[int, int, int, int],
+    sphereW: int
+) -> typing.List[typing.Tuple[slice, slice]]:
+    _, _, col0, ncols = window
+    first = min(ncols, sphereW - col0)
+    slices = [(slice(col0, col0 + first), slice(0, first))]
+    if first < ncols:
+        slices.append((slice(0, ncols - first), slice(first, ncols)))
+    return slices
+
+# rows (row0, row1) of a view geometry, None if they are outside of its window
+def slice_view(view: ViewGeometry, rows: typing.Tuple[int, int]) -> ViewGeometry:
+    row0 = max(rows[0], view.window[0])
+    row1 = min(rows[1], view.window[1])
+    if row0 >= row1:
+        return None
+    part = slice(row0 - view.window[0], row1 - view.window[0])
+    return ViewGeometry(
+        view.mapx[part],
+        None if view.mapy is None else view.mapy[part],
+        view.crop,
+        view.valid[part],
+        (row0, row1, view.window[2], view.window[3])
+    )
+
+# with rows = (row0, row1), only the part of the view within these rows is
+# computed, None if the view does not reach into them. views of the cutouts
+# of reduced source images are computed at full size and converted, see
+# cutout_factor
+def view_geometry(
+    imshape: typing.Tuple[int, int],
     imHoriFOV: float,
     sphereW: int,
     sphereH: int,
     x: float,
     y: float,
-    interpolate: bool,
-    nr: int,
-    weightByCenterDist: bool = False
-):
+    rows: typing.Tuple[int, int] = None
+) -> ViewGeometry:
+    factor = cutout_factor(imshape)
+    scaledshape = imshape
+    if factor > 1:
+        imshape = cutout_shape()
+    window = view_footprint(imshape, imHoriFOV, sphereW, sphereH, x, y)
+    if not(rows is None):
+        if max(rows[0], window[0]) >= min(rows[1], window[1]):
+            return None
+        window = (max(rows[0], window[0]), min(rows[1], window[1]), window[2], window[3])
     # map pixel in panorama to viewing direction
-    TX, TY = np.meshgrid(np.array(range(sphereW)), np.array(range(sphereH)))
-    TX = TX.flatten('F')
-    TY = TY.flatten('F')
+    TX, TY = np.meshgrid(
+        np.mod(np.arange(window[2], window[2] + window[3]), sphereW),
+        np.arange(window[0], window[1])
+    )
     ANGx = ((TX - (sphereW / 2) - 0.5) / sphereW) * math.pi * 2.0
     ANGy = (-(TY - (sphereH / 2) - 0.5) / sphereH) * math.pi
     # compute the radius of ball
-    imH = im.shape[0]
-    imW = im.shape[1]
+    imH = imshape[0]
+    imW = imshape[1]
     R = (imW/2) / math.tan(imHoriFOV/2)
     # im is the tangent plane, contacting with ball at [x0 y0 z0]
     x0 = R * math.cos(y) * math.sin(x)
@@ -160,40 +612,203 @@ def im2sphere(
     # vector in plane: [x1-x0 y1-y0 z1-z0]
     # positive x vector: vecposX = [cos(x) -sin(x) 0]
     # positive y vector: vecposY = [x0 y0 z0] x vecposX
-    vec = np.transpose(np.array([x1 - x0, y1 - y0, z1 - z0]))
-    vecposX = np.transpose(np.array([math.cos(x), -math.sin(x), 0]))
-    deltaX = np.dot(vecposX,np.transpose(vec)) / np.sqrt(np.dot(vecposX,np.transpose(vecposX)))
+    vecposX = np.array([math.cos(x), -math.sin(x), 0])
+    vecposX = vecposX / np.linalg.norm(vecposX)
     vecposY = np.cross(np.array([x0, y0, z0]), vecposX)
-    deltaY = np.dot(vecposY,np.transpose(vec)) / np.sqrt(np.dot(vecposY,np.transpose(vecposY)))
+    vecposY = vecposY / np.linalg.norm(vecposY)
+    deltaX = vecposX[0] * (x1 - x0) + vecposX[1] * (y1 - y0) + vecposX[2] * (z1 - z0)
+    deltaY = vecposY[0] * (x1 - x0) + vecposY[1] * (y1 - y0) + vecposY[2] * (z1 - z0)
     # convert to im coordinates
-    Px = np.reshape(deltaX, (sphereH, sphereW),'F') + (imW+1)/2
-    Py = np.reshape(deltaY, (sphereH, sphereW),'F') + (imH+1)/2
-    # warp image
-    sphere_img = warp_image_fast(im, Px, Py, interpolate, (sphereW, sphereH), nr)
-    validMap = np.zeros((sphere_img.shape[0], sphere_img.shape[1]))
-    validMap[:,:] = np.logical_not(np.isnan(sphere_img[:,:,0])).astype(float)
-
-    if weightByCenterDist:
-        weightIm = np.zeros((im.shape[0],im.shape[1],1))
-        c0 = im.shape[0] / 2
-        c1 = im.shape[1] / 2
-        for i in range(im.shape[0]):
-            for j in range(im.shape[1]):
-                weightIm[i,j,0] = (1 - abs(c0 - i)/c0) * (1 - abs(c1 - j)/c1)
-                
-        weightImWarped = warp_image_fast(weightIm, Px, Py,False,(sphereW,sphereH),nr)
-
-        validMap = weightImWarped[:,:,0]
-        validMap[sphere_img[:,:,0]<1] = 0
-
-    else:
-        validMap[sphere_img[:,:,0]<0] = 0
+    Px = deltaX + (imW+1)/2
+    Py = deltaY + (imH+1)/2
+    if factor > 1:
+        # P is pixel P + 1 of the cutout, as the crop starts at 1 (see below),
+        # and pixel p of the full size image is at (p - (factor-1)/2)/factor of
+        # the reduced one, whose pixels are the means of factor x factor blocks
+        Px = (Px + 1 + imcutout[1][0] - (factor - 1) / 2) / factor - imcutout[1][0] // factor - 1
+        Py = (Py + 1 + imcutout[0][0] - (factor - 1) / 2) / factor - imcutout[0][0] // factor - 1
+        imH, imW = scaledshape[0], scaledshape[1]
+    # the full panorama always extends beyond the source image, so the crop is
+    # the whole image except for the first row and column
+    minX, minY, maxX, maxY = 1, 1, imW, imH
+    mapx = (Px - minX + 1).astype(np.float32)
+    mapy = (Py - minY + 1).astype(np.float32)
+    valid = valid_map(mapx, mapy, (minY, maxY, minX, maxX))
     # view direction: [alpha belta gamma]
     # contacting point direction: [x0 y0 z0]
     # so division>0 are valid region
-    validMap[np.reshape(division, (sphereH, sphereW), 'F') < 0] = 0
+    valid[division < 0] = False
+    return ViewGeometry(mapx, mapy, (minY, maxY, minX, maxX), valid, window)
+
+# compact fixed point version of a view: mapx holds the source coordinates
+# (CV_16SC2), mapy the interpolation table for bilinear warps (1/32 pixel
+# steps) and is None for nearest neighbour warps. converted once, the maps are
+# passed to cv2.remap as they are, which depending on the OpenCV version saves
+# the conversion on every call; they take 6 (bilinear) or 4 (nearest) instead
+# of 8 bytes per pixel.
+# nearest neighbour warps are identical to those with float maps. bilinear
+# warps sample up to 1/64 pixel off in x and y, so values differ by at most
+# 1/32 of the largest difference between neighbouring source pixels, plus 1
+# for rounding of integer images.
+def fixed_point_view(view: ViewGeometry, interpolate: bool) -> ViewGeometry:
+    # only valid pixels need to be representable
+    mapx = np.where(view.valid, view.mapx, fixed_point_outside).astype(np.float32)
+    mapy = np.where(view.valid, view.mapy, fixed_point_outside).astype(np.float32)
+    map1, map2 = cv2.convertMaps(mapx, mapy, cv2.CV_16SC2, nninterpolation=not interpolate)
+    return view._replace(mapx=map1, mapy=None if not interpolate else map2)
+
+# nearest source pixel (in the crop) per panorama pixel of a view, as used by
+# nearest neighbour warps: rounded half to even like cv2.remap, fixed point
+# maps of nearest neighbour views hold them already
+def nearest_coordinates(view: ViewGeometry):
+    if view.mapx.dtype == np.int16:
+        return view.mapx[:,:,0], view.mapx[:,:,1]
+    return np.rint(view.mapx), np.rint(view.mapy)
+
+# pixels whose interpolation footprint lies fully inside the source crop
+def valid_map(
+    mapx: np.array,
+    mapy: np.array,
+    crop: typing.Tuple[int, int, int, int]
+) -> np.array:
+    minY, maxY, minX, maxX = crop
+    return (mapx >= 0) & (mapx <= maxX - minX - 1) & (mapy >= 0) & (mapy <= maxY - minY - 1)
+
+# warped view and its weights, on the window of the geometry only
+def project_view(
+    im: np.array,
+    geometry: ViewGeometry,
+    interpolate: bool,
+    weightByCenterDist: bool = False
+):
+    if not weightByCenterDist:
+        # warp image
+        sphere_img = warp_view(im, geometry, interpolate)
+        validMap = geometry.valid.astype(float)
+        return sphere_img, validMap
+
+    # the weight image is warped as an additional channel in the same pass
+    weightIm = center_weight(im.shape[0], im.shape[1], im.dtype)
+    warped = warp_view(np.concatenate((im, weightIm), axis=2), geometry, interpolate)
+    sphere_img = warped[:,:,:-1]
+    validMap = warped[:,:,-1] / weight_scale(im.dtype)
+    validMap[sphere_img[:,:,0]<1] = 0
+    validMap[np.logical_not(geometry.valid)] = 0
+    return sphere_img, validMap
+
+# full value of integer images, so weights can be stacked with them
+def weight_scale(dtype: np.dtype) -> float:
+    if np.issubdtype(dtype, np.integer):
+        return float(np.iinfo(dtype).max)
+    return 1.0
+
+# weight decreasing linearly towards the image border, only depends on the
+# image shape and is therefore computed once
+@functools.lru_cache(maxsize=8)
+def center_weight(imH: int, imW: int, dtype: np.dtype = np.float64) -> np.array:
+    c0 = imH / 2
+    c1 = imW / 2
+    weightIm = np.outer(1 - np.abs(c0 - np.arange(imH))/c0, 1 - np.abs(c1 - np.arange(imW))/c1)
+    weightIm = np.reshape(weightIm * weight_scale(dtype), (imH, imW, 1))
+    if np.issubdtype(dtype, np.integer):
+        weightIm = np.rint(weightIm)
+    weightIm = weightIm.astype(dtype)
+    weightIm.flags.writeable = False
+    return weightIm
+
+# full size panorama of a single view
+def im2sphere(
+    im: np.array,
+    imHoriFOV: float,
+    sphereW: int,
+    sphereH: int,
+    x: float,
+    y: float,
+    interpolate: bool,
+    nr: int,
+    weightByCenterDist: bool = False,
+    geometry: ViewGeometry = None
+):
+    if geometry is None:
+        geometry = view_geometry(im.shape, imHoriFOV, sphereW, sphereH, x, y)
+    window_img, window_map = project_view(im, geometry, interpolate, weightByCenterDist)
+    sphere_img = np.zeros((sphereH, sphereW, window_img.shape[2]), window_img.dtype)
+    validMap = np.zeros((sphereH, sphereW))
+    rows = slice(geometry.window[0], geometry.window[1])
+    for cols, wcols in window_slices(geometry.window, sphereW):
+        sphere_img[rows,cols] = window_img[:,wcols]
+        validMap[rows,cols] = window_map[:,wcols]
     return sphere_img, validMap
    
+# derive a smaller panorama from a stitched one
+# color is area averaged, depth area averaged over valid (non-zero) pixels only,
+# and labels take the most frequent label of each block for integer factors
+# and the nearest pixel otherwise
+# with stitched, pano is a panorama of view_geometry, see align_blocks, and
+# above the rows before it when it is a strip of one
+def downsample_pano(
+    pano: np.array,
+    outsize: typing.Tuple[int, int],
+    kind: str,
+    stitched: bool = False,
+    above: np.array = None
+) -> np.array:
+    nchannels = pano.shape[2]
+    if stitched:
+        pano = align_blocks(pano, round(pano.shape[1] / outsize[0]) - 1, above)
+    if kind == 'labels':
+        factor = pano.shape[1] // outsize[0]
+        if pano.shape[1] == factor * outsize[0] and pano.shape[0] == factor * outsize[1]:
+            return label_mode(pano, factor)
+        small = cv2.resize(pano, tuple(outsize), interpolation=cv2.INTER_NEAREST_EXACT)
+    elif kind == 'depth':
+        valid = (pano[:,:,0] > 0).astype(np.float32)
+        total = cv2.resize(pano.astype(np.float32), tuple(outsize), interpolation=cv2.INTER_AREA)
+        count = cv2.resize(valid, tuple(outsize), interpolation=cv2.INTER_AREA)
+        total = np.reshape(total, (outsize[1], outsize[0], nchannels))
+        small = np.zeros(total.shape, pano.dtype)
+        np.divide(total, count[:,:,np.newaxis], out=small, where=count[:,:,np.newaxis] > 0, casting='unsafe')
+    else:
+        small = cv2.resize(pano, tuple(outsize), interpolation=cv2.INTER_AREA)
+    return np.reshape(small, (outsize[1], outsize[0], nchannels))
+
+# pixel i of a panorama of width W stitched by view_geometry is at the angle
+# of i - W/2 - 0.5, so a block of f pixels starting at fj is (f-1)/f pixels off
+# pixel j of the panorama stitched at width W/f. pano is returned moved by
+# shift = f-1 pixels right and down, so that the blocks end at fj instead.
+# columns wrap around, the rows moved in are above (the last rows before a
+# strip) or repeat the first row
+def align_blocks(pano: np.array, shift: int, above: np.array = None) -> np.array:
+    if shift <= 0:
+        return pano
+    if above is None:
+        above = np.repeat(pano[:1], shift, axis=0)
+    aligned = np.empty_like(pano)
+    for rows, source in ((slice(0, shift), above[-shift:]), (slice(shift, None), pano[:-shift])):
+        aligned[rows,shift:] = source[:,:-shift]
+        aligned[rows,:shift] = source[:,-shift:]
+    return aligned
+
+# most frequent label (all channels of a pixel) in each factor x factor block,
+# ties are resolved in favour of the first pixel of the block
+def label_mode(labels: np.array, factor: int) -> np.array:
+    H = labels.shape[0] // factor
+    W = labels.shape[1] // factor
+    nchannels = labels.shape[2]
+    blocks = np.reshape(labels, (H, factor, W, factor, nchannels))
+    blocks = np.reshape(np.transpose(blocks, (0, 2, 1, 3, 4)), (H, W, factor * factor, nchannels))
+    # one comparable key per pixel
+    keys = np.zeros(blocks.shape[0:3], np.int64)
+    for c in range(nchannels):
+        keys = keys * (int(labels[:,:,c].max()) + 1) + blocks[:,:,:,c]
+    counts = np.zeros(keys.shape, np.int32)
+    for j in range(factor * factor):
+        counts[:,:,j] = np.count_nonzero(keys == keys[:,:,j,np.newaxis], axis=2)
+    best = np.argmax(counts, axis=2)
+    return np.take_along_axis(blocks, best[:,:,np.newaxis,np.newaxis], axis=2)[:,:,0,:]
+
+# returns the warped image as float64, -1 where the maps point outside of im
+# all channels are remapped in one call, see warp_view for stitching views
 def warp_image_fast(
     im: np.array,
     XXdense: np.array,
@@ -202,23 +817,37 @@ def warp_image_fast(
     outsize: typing.Tuple[int, int],
     nr: int
 ):
-    nchannels = im.shape[2]
     minX = max(1,math.floor(XXdense.min()) - 1)
     minY = max(1,math.floor(YYdense.min()) - 1)
     maxX = min(im.shape[1], math.ceil(XXdense.max()) + 1)
     maxY = min(im.shape[0], math.ceil(YYdense.max()) + 1)
-    im = im[minY:maxY, minX:maxX, :]
-    im_warp = np.zeros((outsize[1], outsize[0], nchannels))
+    im = im[minY:maxY, minX:maxX, :].astype(np.float32)
     intermode = cv2.INTER_NEAREST
     if interpolate:
         intermode = cv2.INTER_LINEAR
-    for i in range(nchannels):
-        mapx = XXdense-minX + 1
-        mapy = YYdense-minY + 1
-        im_warp[:,:,i] = cv2.remap(im[:,:,i].astype(np.float32), mapx.astype(np.float32), mapy.astype(np.float32), 
-               interpolation=intermode, borderMode=cv2.BORDER_CONSTANT, borderValue=(-1,-1,-1) )
-    return im_warp
-
-
-
+    mapx = (XXdense-minX + 1).astype(np.float32)
+    mapy = (YYdense-minY + 1).astype(np.float32)
+    im_warp = cv2.remap(im, mapx, mapy,
+        interpolation=intermode, borderMode=cv2.BORDER_CONSTANT, borderValue=(-1,-1,-1,-1))
+    return np.reshape(im_warp, (outsize[1], outsize[0], im.shape[2])).astype(np.float64)
 
+# warp with precomputed maps, see view_geometry and fixed_point_view
+# all channels are remapped in one call and keep the dtype of im (uint8 color,
+# uint16 depth), pixels outside of geometry.valid are undefined
+def warp_view(
+    im: np.array,
+    geometry: ViewGeometry,
+    interpolate: bool
+):
+    minY, maxY, minX, maxX = geometry.crop
+    im = im[minY:maxY, minX:maxX, :]
+    if not(im.dtype in remap_dtypes):
+        im = im.astype(np.float32)
+    intermode = cv2.INTER_NEAREST
+    if interpolate:
+        intermode = cv2.INTER_LINEAR
+    with profiling.stage("remap") as stage:
+        im_warp = cv2.remap(im, geometry.mapx, geometry.mapy, 
+            interpolation=intermode, borderMode=cv2.BORDER_CONSTANT, borderValue=0)
+        stage.bytes = im_warp.nbytes
+    return np.reshape(im_warp, (im_warp.shape[0], im_warp.shape[1], im.shape[2]))
@@ -0,0 +1,156 @@
+# Created 2020 by JOANNEUM RESEARCH as part of the ATLANTIS H2020 project
+# https://www.joanneum.at
+# http://www.atlantis-ar.eu
+#
+# This tool is part of a project that has received funding from the European
+# Union's Horizon 2020 research and innovation programme under grant
+# agreement No 951900.
+
+# stitching of Matterport skybox faces to an equirectangular panorama, with
+# the same result as py360convert.c2e (bilinear, py360convert >= 1.0) on the
+# reordered and flipped faces followed by np.fliplr
+#
+# the sampling map depends on the face and output size only, so it is
+# computed once. the faces are copied into an atlas with a border of one
+# pixel taken from the neighbouring faces, with the flips and the order
+# py360convert expects folded into the copy, and sampled with a single
+# fixed point remap of all channels, with the final flip folded into the map.
+
+import functools
+import typing
+import numpy as np
+import cv2
+# conversion package for panoramic images
+# https://github.com/sunset1995/py360convert
+# can be installed using pip install py360convert
+from py360convert.utils import equirect_uvgrid, equirect_facetype
+import profiling
+
+# order of the skybox images of a location
+face_seq = ['U','B','R','F','L','D']
+# largest reduction of faces decoded at a smaller size (JPEG DCT scaling)
+max_decode_factor = 8
+
+# py360convert's faces (front, right, back, left, up, down) as the face index
+# in face_seq and the flips applied to it
+_faces = [(3, False, True), (2, False, False), (1, False, False), (4, False, True), (0, False, False), (5, True, False)]
+_FRONT, _RIGHT, _BACK, _LEFT, _UP, _DOWN = range(6)
+
+class CubeGeometry(typing.NamedTuple):
+    face_width: int
+    # fixed point remap table into the atlas
+    map1: np.array
+    map2: np.array
+    # atlas border pixels, as flat indices, and the interior pixels they copy
+    border: np.array
+    border_source: np.array
+
+# border of one pixel around each face, in the order py360convert fills it
+def _pad(padded: np.array) -> None:
+    above, below, left, right = (0, slice(None)), (-1, slice(None)), (slice(None), 0), (slice(None), -1)
+    padded[_FRONT][above] = padded[_UP, -2, :]
+    padded[_FRONT][below] = padded[_DOWN, 1, :]
+    padded[_RIGHT][above] = padded[_UP, ::-1, -2]
+    padded[_RIGHT][below] = padded[_DOWN, :, -2]
+    padded[_BACK][above] = padded[_UP, 1, ::-1]
+    padded[_BACK][below] = padded[_DOWN, -2, ::-1]
+    padded[_LEFT][above] = padded[_UP, :, 1]
+    padded[_LEFT][below] = padded[_DOWN, ::-1, 1]
+    padded[_UP][above] = padded[_BACK, 1, ::-1]
+    padded[_UP][below] = padded[_FRONT, 1, :]
+    padded[_DOWN][above] = padded[_FRONT, -2, :]
+    padded[_DOWN][below] = padded[_BACK, -2, ::-1]
+    padded[_FRONT][left] = padded[_LEFT, :, -2]
+    padded[_FRONT][right] = padded[_RIGHT, :, 1]
+    padded[_RIGHT][left] = padded[_FRONT, :, -2]
+    padded[_RIGHT][right] = padded[_BACK, :, 1]
+    padded[_BACK][left] = padded[_RIGHT, :, -2]
+    padded[_BACK][right] = padded[_LEFT, :, 1]
+    padded[_LEFT][left] = padded[_BACK, :, -2]
+    padded[_LEFT][right] = padded[_FRONT, :, 1]
+    padded[_UP][left] = padded[_LEFT, 1, :]
+    padded[_UP][right] = padded[_RIGHT, 1, ::-1]
+    padded[_DOWN][left] = padded[_LEFT, -2, ::-1]
+    padded[_DOWN][right] = padded[_RIGHT, -2, :]
+
+# geometry for faces of face_width pixels and an output of outsize (w, h),
+# for faces decoded at 1/factor of their size the coordinates are computed
+# for the full size faces and converted
+@functools.lru_cache(maxsize=4)
+def cube_geometry(face_width: int, outsize: typing.Tuple[int, int], factor: int = 1) -> CubeGeometry:
+    w, h = outsize
+    u, v = equirect_uvgrid(h, w)
+    tp = equirect_facetype(h, w)
+    coor_x = np.empty((h, w), dtype=np.float32)
+    coor_y = np.empty((h, w), dtype=np.float32)
+    face_w2 = face_width * factor / 2
+
+    mask = tp < _UP
+    angles = u[mask] - (np.pi / 2 * tp[mask])
+    coor_x[mask] = face_w2 * np.tan(angles)
+    coor_y[mask] = -face_w2 * np.tan(v[mask]) / np.cos(angles)
+    mask = tp == _UP
+    c = face_w2 * np.tan(np.pi / 2 - v[mask])
+    coor_x[mask] = c * np.sin(u[mask])
+    coor_y[mask] = c * np.cos(u[mask])
+    mask = tp == _DOWN
+    c = face_w2 * np.tan(np.pi / 2 - np.abs(v[mask]))
+    coor_x[mask] = c * np.sin(u[mask])
+    coor_y[mask] = -c * np.cos(u[mask])
+
+    coor_x += face_w2
+    coor_y += face_w2
+    coor_x.clip(0, face_width * factor, out=coor_x)
+    coor_y.clip(0, face_width * factor, out=coor_y)
+    if factor > 1:
+        # pixel p of the full size face is at (p - (factor-1)/2)/factor of
+        # the reduced one, whose pixels are the means of factor x factor blocks
+        coor_x -= (factor - 1) / 2
+        coor_x /= factor
+        coor_y -= (factor - 1) / 2
+        coor_y /= factor
+    # into the face's place in the atlas, past its border
+    coor_x += 1
+    coor_y += 1
+    coor_y += np.multiply(tp, face_width + 2, dtype=np.float32)
+    map1, map2 = cv2.convertMaps(
+        np.ascontiguousarray(coor_x[:, ::-1]), np.ascontiguousarray(coor_y[:, ::-1]), cv2.CV_16SC2, nninterpolation=False
+    )
+
+    # atlas pixel each atlas pixel is copied from
+    size = face_width + 2
+    index = np.arange(6 * size * size).reshape(6, size, size)
+    padded = np.pad(index[:, 1:-1, 1:-1], ((0, 0), (1, 1), (1, 1)), mode='edge')
+    _pad(padded)
+    border = np.flatnonzero(padded.ravel() != index.ravel())
+    return CubeGeometry(face_width, map1, map2, border, padded.ravel()[border])
+
+# largest power of two by which faces of face_width can be reduced without
+# undersampling a panorama of width sphereW, a face spans a quarter of it
+def decode_factor(sphereW: int, face_width: int) -> int:
+    factor = 1
+    while factor < max_decode_factor and face_width / (factor * 2) >= sphereW / 4:
+        factor *= 2
+    return factor
+
+# equirectangular panorama of size outsize (w, h) from the skybox images of a
+# location (in the order of face_seq), of their dtype. factor is the one the
+# faces were decoded at, see decode_factor
+def combine_faces(images: typing.List[np.array], outsize: typing.Tuple[int, int], factor: int = 1) -> np.array:
+    face_width = images[0].shape[1]
+    geometry = cube_geometry(face_width, tuple(outsize), factor)
+    size = face_width + 2
+    atlas = np.empty((6, size, size) + images[0].shape[2:], dtype=images[0].dtype)
+    for k, (nr, flipud, fliplr) in enumerate(_faces):
+        face = images[nr]
+        if flipud:
+            face = face[::-1]
+        if fliplr:
+            face = face[:, ::-1]
+        atlas[k, 1:-1, 1:-1] = face
+    flat = atlas.reshape((6 * size * size,) + atlas.shape[3:])
+    flat[geometry.border] = flat[geometry.border_source]
+    with profiling.stage("remap") as stage:
+        eqr = cv2.remap(atlas.reshape((6 * size, size) + atlas.shape[3:]), geometry.map1, geometry.map2, cv2.INTER_LINEAR)
+        stage.bytes = eqr.nbytes
+    return eqr.reshape(eqr.shape[:2] + atlas.shape[3:])
@@ -0,0 +1,75 @@
+# Created 2020 by JOANNEUM RESEARCH as part of the ATLANTIS H2020 project
+# https://www.joanneum.at
+# http://www.atlantis-ar.eu
+#
+# This tool is part of a project that has received funding from the European
+# Union's Horizon 2020 research and innovation programme under grant
+# agreement No 951900.
+
+# per scan record of the panoramas produced, so that reruns only redo work
+# units whose outputs are missing or stale
+#
+# every entry holds a fingerprint of the inputs of a unit, the parameters and
+# tool version its outputs were produced with, and the output files relative
+# to the manifest. the manifest is written to a temporary file and renamed
+# into place, so an interrupted run leaves a consistent manifest behind.
+
+import json
+import os
+import time
+import logging
+
+log = logging.getLogger(__name__)
+
+# bump when the layout of the manifest changes
+manifest_version = 1
+# seconds between saves while entries are recorded
+save_interval = 5.0
+
+class Manifest:
+    def __init__(self, path: str):
+        self.path = path
+        self.entries = {}
+        self.dirty = False
+        self.saved = time.monotonic()
+        try:
+            with open(path, 'r') as f:
+                data = json.load(f)
+            if data.get('version') == manifest_version:
+                self.entries = data['units']
+        except FileNotFoundError:
+            pass
+        except (ValueError, KeyError, AttributeError):
+            log.warning(f"ignoring unreadable manifest {path}")
+
+    # output path as stored in the entries
+    def relative(self, path: str) -> str:
+        return os.path.relpath(path, os.path.dirname(self.path))
+
+    def up_to_date(self, key: str, entry: dict) -> bool:
+        return self.entries.get(key) == entry and all(
+            os.path.exists(os.path.join(os.path.dirname(self.path), p)) for p in entry['outputs']
+        )
+
+    # forget a unit before its outputs are rewritten
+    def discard(self, key: str) -> None:
+        if key in self.entries:
+            del self.entries[key]
+            self.dirty = True
+
+    def record(self, key: str, entry: dict) -> None:
+        self.entries[key] = entry
+        self.dirty = True
+        if time.monotonic() - self.saved > save_interval:
+            self.save()
+
+    def save(self) -> None:
+        if not self.dirty:
+            return
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmppath = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmppath, 'w') as f:
+            json.dump({ 'version': manifest_version, 'units': self.entries }, f, indent=1, sort_keys=True)
+        os.replace(tmppath, self.path)
+        self.dirty = False
+        self.saved = time.monotonic()
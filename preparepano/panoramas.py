@@ -0,0 +1,212 @@
+# Created 2020 by JOANNEUM RESEARCH as part of the ATLANTIS H2020 project
+# https://www.joanneum.at
+# http://www.atlantis-ar.eu
+#
+# This tool is part of a project that has received funding from the European
+# Union's Horizon 2020 research and innovation programme under grant
+# agreement No 951900.
+
+# panoramas of Matterport3D scans generated on demand as arrays, e.g. inside
+# a training process, rather than written to files by prepare_matterport
+#
+#     source = panoramas.PanoramaSource(m3d_path)
+#     pano = source.panoramas(scan_id, location, 1024, ['color', 'depth'])
+#     dataset = panoramas.PanoramaDataset(source, source.scan_locations(scan_id), 512)
+#     for sample in dataset:
+#         sample['scan_id'], sample['location'], sample['color'], ...
+#
+# the panoramas are those prepare_matterport writes (same values and dtypes).
+# decoded source images and stitching geometry are kept in a cache bounded in
+# bytes, dropping the least recently used entries, so that later epochs only
+# stitch. the dataset stitches in background threads, which share the cache
+# (decoding and warping release the GIL)
+
+import collections
+import concurrent.futures
+import threading
+import typing
+import numpy as np
+import createpano
+import cubemap
+import prepare_matterport
+import remapstore
+import logging
+
+log = logging.getLogger(__name__)
+
+default_types = ('color', 'depth', 'classes', 'instances')
+
+# least recently used cache bounded by the total bytes of its entries
+class LRUCache:
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            if not(key in self._entries):
+                return None
+            self._entries.move_to_end(key)
+            return self._entries[key][0]
+
+    # an entry larger than the cache is not kept, putting a key again updates
+    # its size (e.g. once a geometry has computed its views)
+    def put(self, key, value, nbytes: int) -> None:
+        with self._lock:
+            if key in self._entries:
+                self.bytes -= self._entries.pop(key)[1]
+            if nbytes > self.max_bytes:
+                return
+            self._entries[key] = (value, nbytes)
+            self.bytes += nbytes
+            while self.bytes > self.max_bytes:
+                _, (_, size) = self._entries.popitem(last=False)
+                self.bytes -= size
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self.bytes = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+# panoramas of the scans below m3d_path, with the options of prepare_matterport
+# (see prepare_matterport.Options), cache_mb bounds the cached inputs and geometry
+class PanoramaSource:
+    def __init__(
+        self,
+        m3d_path: str,
+        warp_depth: bool = True,
+        low_memory: bool = False,
+        fixed_point: bool = False,
+        scaled_decoding: bool = False,
+        store: remapstore.RemapStore = None,
+        camera_cache: str = None,
+        cache_mb: int = 1024
+    ):
+        self.m3d_path = m3d_path
+        self.warp_depth = warp_depth
+        self.low_memory = low_memory
+        self.fixed_point = fixed_point
+        self.scaled_decoding = scaled_decoding
+        self.store = store
+        self.camera_cache = camera_cache
+        self.cache = LRUCache(cache_mb << 20)
+
+    # (scan_id, location) of every location of a scan with camera parameters
+    def scan_locations(self, scan_id: str) -> typing.List[typing.Tuple[str, str]]:
+        angles = prepare_matterport.load_scan_angles(self.m3d_path, scan_id, self.camera_cache)
+        return [(scan_id, location) for location in sorted(angles.keys())]
+
+    # source images of a type of a location, as prepare_matterport.load_unit
+    # returns them for panoramas of width
+    def images(self, scan_id: str, location: str, file_type: str, width: int) -> typing.List[np.array]:
+        name, extension = prepare_matterport._CHOICE_MAPPING_[file_type][0:2]
+        # images decoded at full size serve every width
+        sphereW = width if self.scaled_decoding else None
+        key = ('images', scan_id, location, file_type, sphereW)
+        images = self.cache.get(key)
+        if images is None:
+            images = prepare_matterport.load_location_images(
+                self.m3d_path, scan_id, name, extension, location, sphereW, self.warp_depth
+            )
+            if not images:
+                raise FileNotFoundError(f"{scan_id}: no {file_type} images of location {location}")
+            self.cache.put(key, images, sum(im.nbytes for im in images))
+        return images
+
+    # stitching geometry of a location for panoramas of width
+    def geometry(self, scan_id: str, location: str, width: int) -> createpano.PanoGeometry:
+        key = ('geometry', scan_id, location, width)
+        geometry = self.cache.get(key)
+        if geometry is None:
+            angles = prepare_matterport.load_scan_angles(self.m3d_path, scan_id, self.camera_cache)
+            geometry = createpano.PanoGeometry(
+                angles[location], (width, width // 2), store=self.store, fixed_point=self.fixed_point
+            )
+            self.cache.put(key, geometry, 0)
+        return geometry
+
+    # panorama of a type of a location, of shape (width // 2, width, channels)
+    def panorama(self, scan_id: str, location: str, file_type: str, width: int) -> np.array:
+        name, extension, is_skyBox, _ = prepare_matterport._CHOICE_MAPPING_[file_type]
+        images = self.images(scan_id, location, file_type, width)
+        size = (width, width // 2)
+        if is_skyBox:
+            factor = 1
+            if self.scaled_decoding:
+                face_width = prepare_matterport.source_format(self.m3d_path, scan_id, name, extension)[0]
+                factor = prepare_matterport.decode_factor(name, width, face_width)
+            eqr = cubemap.combine_faces(images, size, factor)
+        else:
+            geometry = self.geometry(scan_id, location, width)
+            blending, is_depth = prepare_matterport.stitch_mode(name)
+            eqr = createpano.combine_views(images, geometry.v, size, blending, is_depth, geometry, self.low_memory)
+            # the views computed meanwhile count towards the cache
+            self.cache.put(('geometry', scan_id, location, width), geometry, geometry.nbytes())
+        return eqr.astype(prepare_matterport.panorama_dtype(name), copy=False)
+
+    # panoramas of the types of a location by type
+    def panoramas(
+        self,
+        scan_id: str,
+        location: str,
+        width: int,
+        types: typing.Iterable[str] = default_types
+    ) -> typing.Dict[str, np.array]:
+        return { file_type: self.panorama(scan_id, location, file_type, width) for file_type in types }
+
+# iterable over the panoramas of (scan_id, location) items, as dicts with
+# scan_id, location and the panorama of each type. items are stitched by
+# workers threads, up to prefetch items ahead of the one yielded. with
+# shuffle, every iteration (epoch) visits the items in another order
+class PanoramaDataset:
+    def __init__(
+        self,
+        source: PanoramaSource,
+        items: typing.List[typing.Tuple[str, str]],
+        width: int,
+        types: typing.Iterable[str] = default_types,
+        workers: int = 2,
+        prefetch: int = 4,
+        shuffle: bool = False,
+        seed: int = None
+    ):
+        self.source = source
+        self.items = list(items)
+        self.width = width
+        self.types = tuple(types)
+        self.workers = max(1, workers)
+        self.prefetch = max(1, prefetch)
+        self.shuffle = shuffle
+        self._rng = np.random.default_rng(seed)
+
+    def __len__(self) -> int:
+        return len(self.items)
+
+    def sample(self, item: typing.Tuple[str, str]) -> dict:
+        scan_id, location = item
+        sample = { 'scan_id': scan_id, 'location': location }
+        sample.update(self.source.panoramas(scan_id, location, self.width, self.types))
+        return sample
+
+    def __iter__(self):
+        order = self.items
+        if self.shuffle:
+            order = [self.items[i] for i in self._rng.permutation(len(self.items))]
+        with concurrent.futures.ThreadPoolExecutor(self.workers) as executor:
+            pending = collections.deque()
+            try:
+                for item in order:
+                    pending.append(executor.submit(self.sample, item))
+                    if len(pending) > self.prefetch:
+                        yield pending.popleft().result()
+                while pending:
+                    yield pending.popleft().result()
+            finally:
+                # an iteration stopped early does not wait for the items ahead
+                for future in pending:
+                    future.cancel()
@@ -0,0 +1,160 @@
+# Created 2020 by JOANNEUM RESEARCH as part of the ATLANTIS H2020 project
+# https://www.joanneum.at
+# http://www.atlantis-ar.eu
+#
+# This tool is part of a project that has received funding from the European
+# Union's Horizon 2020 research and innovation programme under grant
+# agreement No 951900.
+
+# streaming PNG encoder: rows are compressed and written as they are added, so
+# a panorama can be written strip by strip without ever being held in memory
+
+import os
+import struct
+import zlib
+import numpy as np
+
+png_signature = b'\x89PNG\r\n\x1a\n'
+# PNG color type by number of channels: gray, gray+alpha, RGB, RGBA
+png_color_types = {1: 0, 2: 4, 3: 2, 4: 6}
+# PNG row filter types. adaptive chooses per row the filter with the smallest
+# sum of absolute (signed) differences, the heuristic recommended by the spec
+png_filters = {'none': 0, 'sub': 1, 'up': 2, 'average': 3, 'paeth': 4}
+# rows filtered at once, few enough for the temporaries to stay in cache
+filter_block_rows = 16
+
+class PngWriter:
+    def __init__(
+        self,
+        path: str,
+        width: int,
+        height: int,
+        channels: int,
+        dtype: np.dtype = np.uint8,
+        compress_level: int = 6,
+        png_filter: str = None
+    ):
+        # filtering does not pay off without compression
+        if png_filter is None:
+            png_filter = 'none' if compress_level == 0 else 'adaptive'
+        if not(png_filter in png_filters or png_filter == 'adaptive'):
+            raise ValueError(f"unknown PNG filter {png_filter}")
+        self.path = path
+        self.width = width
+        self.height = height
+        self.channels = channels
+        self.bitdepth = 16 if np.dtype(dtype).itemsize == 2 else 8
+        self.png_filter = png_filter
+        # bytes per pixel, the distance to the left neighbour for filtering
+        self.bpp = channels * self.bitdepth // 8
+        # last row written, the upper neighbour of the next one
+        self.prior = np.zeros(width * self.bpp, np.uint8)
+        self.rows = 0
+        # written to a temporary name until complete
+        self.file = open(path + '.part', 'wb')
+        self.file.write(png_signature)
+        self._chunk(b'IHDR', struct.pack(
+            '>IIBBBBB', width, height, self.bitdepth, png_color_types[channels], 0, 0, 0
+        ))
+        self.compressor = zlib.compressobj(compress_level)
+
+    def write_rows(self, rows: np.array) -> None:
+        rows = np.reshape(rows, (rows.shape[0], self.width, self.channels))
+        if rows.shape[0] == 0:
+            return
+        if self.rows + rows.shape[0] > self.height:
+            raise ValueError(f"{self.path}: more than {self.height} rows written")
+        # PNG stores 16 bit samples big endian
+        rows = rows.astype('>u2' if self.bitdepth == 16 else np.uint8)
+        raw = np.reshape(rows.view(np.uint8), (rows.shape[0], -1))
+        for block in range(0, raw.shape[0], filter_block_rows):
+            filtered = self._filter(raw[block:block + filter_block_rows])
+            data = self.compressor.compress(filtered.tobytes())
+            if data:
+                self._chunk(b'IDAT', data)
+        self.rows += rows.shape[0]
+
+    def close(self) -> None:
+        if self.file.closed:
+            return
+        complete = self.rows == self.height
+        if complete:
+            self._chunk(b'IDAT', self.compressor.flush())
+            self._chunk(b'IEND', b'')
+        self.file.close()
+        if complete:
+            os.replace(self.path + '.part', self.path)
+        else:
+            os.remove(self.path + '.part')
+            raise ValueError(f"{self.path}: {self.rows} of {self.height} rows written")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            # leave no partial file behind
+            self.file.close()
+            os.remove(self.path + '.part')
+
+    # rows with their filter type byte prepended
+    def _filter(self, raw: np.array) -> np.array:
+        out = np.empty((raw.shape[0], 1 + raw.shape[1]), np.uint8)
+        if self.png_filter == 'none':
+            out[:, 0] = 0
+            out[:, 1:] = raw
+            self.prior = raw[-1]
+            return out
+        # left, upper and upper left neighbours, 0 outside of the image.
+        # differences wrap around modulo 256, as the filters are defined
+        x = raw
+        b = np.concatenate((self.prior[np.newaxis], raw[:-1]))
+        a = np.zeros_like(x)
+        a[:, self.bpp:] = x[:, :-self.bpp]
+        c = np.zeros_like(x)
+        c[:, self.bpp:] = b[:, :-self.bpp]
+        self.prior = raw[-1]
+        candidates = {}
+        for name in (png_filters if self.png_filter == 'adaptive' else [self.png_filter]):
+            if name == 'none':
+                candidates[name] = x
+            elif name == 'sub':
+                candidates[name] = x - a
+            elif name == 'up':
+                candidates[name] = x - b
+            elif name == 'average':
+                # floor((a + b) / 2) without overflow
+                candidates[name] = x - ((a >> 1) + (b >> 1) + (a & b & 1))
+            else:
+                # distances of p = a + b - c to a, b and c
+                c16 = c.astype(np.int16)
+                pa = np.subtract(b, c16)
+                pb = np.subtract(a, c16)
+                pc = np.add(pa, pb)
+                np.abs(pa, out=pa)
+                np.abs(pb, out=pb)
+                np.abs(pc, out=pc)
+                predictor = np.where(pb <= pc, b, c)
+                np.copyto(predictor, a, where=(pa <= pb) & (pa <= pc))
+                candidates[name] = x - predictor
+        names = list(candidates)
+        if len(names) == 1:
+            out[:, 0] = png_filters[names[0]]
+            out[:, 1:] = candidates[names[0]]
+            return out
+        # sum of the differences as signed bytes
+        costs = np.stack([
+            np.sum(np.abs(candidates[n].view(np.int8)).view(np.uint8), axis=1, dtype=np.int64) for n in names
+        ])
+        best = np.argmin(costs, axis=0)
+        for i, name in enumerate(names):
+            selected = best == i
+            out[selected, 0] = png_filters[name]
+            out[selected, 1:] = candidates[name][selected]
+        return out
+
+    def _chunk(self, tag: bytes, data: bytes) -> None:
+        self.file.write(struct.pack('>I', len(data)) + tag + data)
+        self.file.write(struct.pack('>I', zlib.crc32(tag + data) & 0xffffffff))
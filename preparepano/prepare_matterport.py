@@ -8,187 +8,979 @@
 
 
 import argparse
+import hashlib
+import io
+import json
 import os
 import sys
+import time
+import typing
 import numpy as np
 from PIL import Image
-# conversion package for panoramic images
-# https://github.com/sunset1995/py360convert
-# can be installed using pip install py360convert
-import py360convert 
 import zipfile
 import createpano
+import cubemap
+import remapstore
+import scanio
+import manifest
+import pngstream
+import profiling
+import shards
+import budget
 import logging
 import tqdm
-import copy
-import math
+import functools
+import contextlib
+import multiprocessing
+import multiprocessing.pool
+import concurrent.futures
+import collections
+import traceback
+import cv2
 
 log = logging.getLogger(__name__)
 
+# recorded in the manifest, bump whenever the panoramas produced from the same
+# inputs with the same parameters change
+tool_version = 3
+
 def unzip(basedir,filename):
     with zipfile.ZipFile(os.path.join(basedir, filename), 'r') as zip_ref:
         zip_ref.extractall(basedir)
 
-def parse_camera_params(filename: str) -> dict:
-    with open(filename, 'r') as f:
-        paramdict = {}
-        while True: 
-            line = f.readline() 
-            if not line: 
-                break
-            lineparts = line.split(" ")
-            if lineparts[0]=="scan":
-                (loc,row,ori) = lineparts[1].split("_", 3)
-                rowid = int(row[1:])
-                ori, _ = os.path.splitext(ori)
-                oriid = int(ori)                
-                trmatrix = np.array([
-                    [float(lineparts[3]), float(lineparts[4]), float(lineparts[5]), float(lineparts[6])],
-                    [float(lineparts[7]), float(lineparts[8]), float(lineparts[9]), float(lineparts[10])],
-                    [float(lineparts[11]), float(lineparts[12]), float(lineparts[13]), float(lineparts[14])],
-                    [float(lineparts[15]), float(lineparts[16]), float(lineparts[17]), float(lineparts[18])]
-                ])
-                if not(loc in paramdict.keys()):
-                    paramdict[loc] = {}
-                if not(rowid in paramdict[loc].keys()):
-                    paramdict[loc][rowid] = {}
-                paramdict[loc][rowid][oriid] = trmatrix
-    return paramdict
+# parsed camera parameters: one record per image with the pose (camera to
+# world) and the intrinsics (from the preceding intrinsics_matrix line)
+def camera_dtype(location_length: int = 32) -> np.dtype:
+    return np.dtype([
+        ('location', f'U{location_length}'),
+        ('row', np.int16),
+        ('yaw', np.int16),
+        ('matrix', np.float64, (4, 4)),
+        ('intrinsics', np.float64, (3, 3))
+    ])
 
+# the numbers of several lines with count numbers each, converted in one call
+def parse_numbers(lines: typing.List[str], count: int) -> np.array:
+    numbers = np.fromstring(" ".join(lines), np.float64, sep=" ")
+    if numbers.size != len(lines) * count:
+        raise ValueError(f"camera parameters: expected {count} numbers per line")
+    return numbers
 
-def correct_depth_distortion(depth_img_in):
-    depth_img = copy.deepcopy(depth_img_in)
-    
-    c1 = depth_img.shape[1]/2
-    c0 = depth_img.shape[0]/2
+# filename is a path or an open text file
+def parse_camera_params(filename: typing.Union[str, typing.TextIO]) -> np.array:
+    with (open(filename, 'r') if isinstance(filename, str) else filename) as f:
+        lines = f.read().splitlines()
+    scan_nr = [i for i, line in enumerate(lines) if line.startswith("scan ")]
+    intrinsics_nr = [i for i, line in enumerate(lines) if line.startswith("intrinsics_matrix ")]
+    # scan <loc>_d<row>_<yaw>.png <loc>_i<row>_<yaw>.jpg <4x4 matrix>
+    scans = [lines[i].split(" ", 3) for i in scan_nr]
+    names = [scan[1].split("_", 3) for scan in scans]
+    cameras = np.zeros(len(scans), camera_dtype(max([len(n[0]) for n in names], default=1)))
+    cameras['location'] = [n[0] for n in names]
+    cameras['row'] = [int(n[1][1:]) for n in names]
+    cameras['yaw'] = [int(n[2].split(".", 1)[0]) for n in names]
+    cameras['matrix'] = np.reshape(parse_numbers([scan[3] for scan in scans], 16), (-1, 4, 4))
+    cameras['intrinsics'] = np.nan
+    if intrinsics_nr:
+        intrinsics = np.reshape(parse_numbers([lines[i].split(" ", 1)[1] for i in intrinsics_nr], 9), (-1, 3, 3))
+        current = np.searchsorted(intrinsics_nr, scan_nr, side='right') - 1
+        cameras['intrinsics'][current >= 0] = intrinsics[current[current >= 0]]
+    return cameras
+
+
+# view angles of all locations of a scan, decoded in one batch
+def get_scan_angles(cameras: np.array) -> dict:
+    views = createpano.rig_rows * createpano.rig_yaws
+    cameras = cameras[np.lexsort((cameras['yaw'], cameras['row'], cameras['location']))]
+    locations = cameras['location'][::views]
+    # every location needs all views of the rig
+    rig = np.arange(views)
+    if len(cameras) != len(locations) * views or np.any(
+        np.reshape(cameras['location'], (-1, views)) != locations[:,np.newaxis]
+    ) or np.any(np.reshape(cameras['row'] * createpano.rig_yaws + cameras['yaw'], (-1, views)) != rig):
+        raise ValueError("camera parameters do not cover the full rig of every location")
+    matrices = np.reshape(cameras['matrix'], (-1, views, 4, 4))
+    return dict(zip(locations.tolist(), createpano.get_angles_batch(matrices)))
+
+# camera parameters of a scan, parsed once per process. with cache_dir, a
+# binary copy is kept there and used as long as the signature of the
+# parameter file (see scanio.file_signature) does not change
+@functools.lru_cache(maxsize=2)
+def load_scan_cameras(m3d_path: str, scan_id: str, cache_dir: str = None) -> np.array:
+    name = "undistorted_camera_parameters"
+    filename = scan_id + ".conf"
+    if not(cache_dir is None):
+        signature = np.array(scanio.file_signature(m3d_path, scan_id, name, filename), np.int64)
+        path = os.path.join(cache_dir, scan_id + ".cameras.npz")
+        try:
+            with np.load(path) as cached:
+                if np.array_equal(cached['signature'], signature):
+                    return cached['cameras']
+        except (OSError, ValueError, KeyError, zipfile.BadZipFile):
+            pass
+    with scanio.open_file(m3d_path, scan_id, name, filename) as f:
+        cameras = parse_camera_params(io.TextIOWrapper(f))
+    if not(cache_dir is None):
+        os.makedirs(cache_dir, exist_ok=True)
+        tmppath = f"{path}.{os.getpid()}.tmp"
+        with open(tmppath, 'wb') as f:
+            np.savez(f, cameras=cameras, signature=signature)
+        os.replace(tmppath, path)
+    return cameras
+
+
+# factor converting depth along the optical axis to distance from the camera
+# center, only depends on the image shape and is therefore computed once
+@functools.lru_cache(maxsize=8)
+def depth_correction_factor(height: int, width: int) -> np.array:
+    c1 = width/2
+    c0 = height/2
     halfFov = createpano.default_fov / 2
+    tan1 = np.tan((np.abs(np.arange(width) - c1)/c1) * halfFov)
+    tan0 = np.tan((np.abs(np.arange(height) - c0)/c0) * halfFov)
+    factor = np.sqrt(1 + tan0[:,np.newaxis]**2 + tan1[np.newaxis,:]**2)
+    factor = np.reshape(factor, (height, width, 1))
+    factor.flags.writeable = False
+    return factor
+
+def correct_depth_distortion(depth_img_in):
+    factor = depth_correction_factor(depth_img_in.shape[0], depth_img_in.shape[1])
+    depth_img = np.multiply(depth_img_in, factor)
+    np.minimum(depth_img, 65535, out=depth_img)
+    return depth_img.astype(depth_img_in.dtype)
     
-    for i in range(depth_img.shape[1]):
-        angle1 = (abs(i-c1)/c1) * halfFov
-        for j in range(depth_img.shape[0]):
-            d1 = math.tan(angle1) * depth_img[j,i,0]
-            angle0 = (abs(j-c0)/c0) * halfFov    
-            d0 = math.tan(angle0) * depth_img[j,i,0] 
-            diag = math.sqrt(d0*d0 + d1*d1)
-            distToCenter = math.sqrt(float(depth_img[j,i,0])*float(depth_img[j,i,0]) + diag*diag)
-            corr = distToCenter - depth_img[j,i,0]
-            
-            if depth_img[j,i,0] >0:
-                result = depth_img[j,i,0] + corr
-                if result>65535:
-                    result = 65535
-                depth_img[j,i,0] = result
-
-        
-    return depth_img
-    
 
-def process_file_type(
-    base_dir: str,
+# a work unit: one panorama type of one location of a scan
+class WorkUnit(typing.NamedTuple):
+    scan_id: str
+    location: str
+    file_type: str
+
+# processing options shared by all work units
+class Options(typing.NamedTuple):
+    m3d_path: str
+    out_path: str
+    out_widths: typing.Tuple[int, ...] = (1024,)
+    warp_depth: bool = True
+    store: remapstore.RemapStore = None
+    low_memory: bool = False
+    save_lookup: bool = False
+    tile_height: int = 0
+    fixed_point: bool = False
+    camera_cache: str = None
+    compress_level: int = None
+    png_filter: str = None
+    color_format: str = 'png'
+    encode_threads: int = 2
+    scaled_decoding: bool = False
+    max_memory: int = 0
+
+# output directory per width, with several widths each gets its own tree
+# below out_path/<width>
+def output_dirs(options: Options, scan_id: str) -> typing.Dict[int, str]:
+    if len(options.out_widths) == 1:
+        return { options.out_widths[0]: os.path.join(options.out_path, scan_id) }
+    return { w: os.path.join(options.out_path, str(w), scan_id) for w in options.out_widths }
+
+# work units of a scan, ordered by location and then by type, so that the
+# types of a location are processed one after the other and share its geometry
+def scan_units(m3d_path: str, scan_id: str, types: typing.List[str]) -> typing.List[WorkUnit]:
+    units = []
+    for file_type in types:
+        name, extension = _CHOICE_MAPPING_[file_type][0:2]
+        try:
+            locations = location_files(m3d_path, scan_id, name, extension)
+        except FileNotFoundError as e:
+            log.error(f"{scan_id}: skipping {file_type}, {e}")
+            continue
+        units.extend(WorkUnit(scan_id, location, file_type) for location in locations)
+    return sorted(units, key=lambda u: (u.scan_id, u.location, types.index(u.file_type)))
+
+# file names of <name> of a scan grouped by location, in file name order
+@functools.lru_cache(maxsize=8)
+def location_files(m3d_path: str, scan_id: str, name: str, extension: str) -> typing.Dict[str, typing.List[str]]:
+    groups = {}
+    for filename in sorted(scanio.list_files(m3d_path, scan_id, name)):
+        if filename.endswith(extension):
+            groups.setdefault(filename.split("_", 1)[0], []).append(filename)
+    return groups
+
+# source images of a location, in file name order, see scanio. with
+# warp_depth depth images are corrected, see correct_depth_distortion. with
+# sphereW, they are decoded at the reduced size panoramas of this width need,
+# views are then cropped after the correction, see createpano.decode_factor
+# and createpano.cutout
+def load_location_images(
+    m3d_path: str,
     scan_id: str,
-    file_type: str,
     name: str,
-    out_dir: str,
     extension: str,
-    is_skyBox: bool,
-    interpolate: bool,
-    warp_depth: bool
-) -> None:
-    face_seq = ['U','B','R','F','L','D']
+    location: str,
+    sphereW: int = None,
+    warp_depth: bool = False
+) -> typing.List[np.array]:
+    images = []
+    for filename in location_files(m3d_path, scan_id, name, extension).get(location, []):
+        with profiling.stage("decode") as stage, scanio.open_file(m3d_path, scan_id, name, filename) as f:
+            im = Image.open(f)
+            factor = 1
+            if not(sphereW is None):
+                factor = decode_factor(name, sphereW, im.width)
+            srcimg = decode_image(im, factor, panorama_kind(name))
+            stage.bytes = srcimg.nbytes
+        if warp_depth and name == "undistorted_depth_images":
+            with profiling.stage("depth_correction"):
+                srcimg = correct_depth_distortion(srcimg)
+        if factor > 1 and name != "matterport_skybox_images":
+            srcimg = createpano.cutout(srcimg, factor)
+        images.append(srcimg)
+    return images
+
+# factor by which source images of <name> of width imW are reduced for
+# panoramas of width sphereW, see load_location_images
+def decode_factor(name: str, sphereW: int, imW: int) -> int:
+    if name == "matterport_skybox_images":
+        return cubemap.decode_factor(sphereW, imW)
+    return createpano.decode_factor(sphereW, imW)
+
+# image of shape (h, w, channels), with factor > 1 reduced to 1/factor of its
+# size: JPEGs are decoded at the reduced size (DCT scaling), other images are
+# downsampled after decoding, color and depth as panoramas are (see
+# createpano.downsample_pano) and labels by taking the pixel nearest to the
+# center of each block, as they are composed by nearest neighbour lookup anyway
+def decode_image(im: Image.Image, factor: int = 1, kind: str = 'color') -> np.array:
+    size = (-(-im.width // factor), -(-im.height // factor))
+    if factor > 1:
+        im.draft(im.mode, size)
+    srcimg = np.array(im)
+    if srcimg.ndim==2:
+        srcimg = np.reshape(srcimg, (srcimg.shape[0],srcimg.shape[1],1))
+    if srcimg.shape[1] != size[0] or srcimg.shape[0] != size[1]:
+        if kind == 'labels':
+            small = cv2.resize(srcimg, size, interpolation=cv2.INTER_NEAREST_EXACT)
+            srcimg = np.reshape(small, (size[1], size[0], srcimg.shape[2]))
+        else:
+            srcimg = createpano.downsample_pano(srcimg, size, kind)
+    return srcimg
+
+@functools.lru_cache(maxsize=2)
+def load_scan_angles(m3d_path: str, scan_id: str, cache_dir: str = None) -> dict:
+    return get_scan_angles(load_scan_cameras(m3d_path, scan_id, cache_dir))
+
+# stitching geometry only depends on the camera poses and is shared by the
+# types of a location, only the location processed last is kept
+_geometry_cache = {}
+
+def location_geometry(unit: WorkUnit, options: Options, equirect_size: typing.List[int]) -> createpano.PanoGeometry:
+    key = (options.m3d_path, unit.scan_id, unit.location, tuple(equirect_size))
+    if not(key in _geometry_cache):
+        _geometry_cache.clear()
+        angles = load_scan_angles(options.m3d_path, unit.scan_id, options.camera_cache)
+        _geometry_cache[key] = createpano.PanoGeometry(
+            angles[unit.location], equirect_size, store=options.store, fixed_point=options.fixed_point
+        )
+    return _geometry_cache[key]
+
+def load_unit(unit: WorkUnit, options: Options) -> typing.List[np.array]:
+    name, extension = _CHOICE_MAPPING_[unit.file_type][0:2]
+    # with scaled_decoding, the images are decoded at the size the largest width needs
+    sphereW = max(options.out_widths) if options.scaled_decoding else None
+    with profiling.labels(*unit):
+        return load_location_images(options.m3d_path, unit.scan_id, name, extension, unit.location, sphereW,
+            options.warp_depth)
+
+# the images of the unit, as load_unit returns them, are loaded unless given.
+# panoramas are encoded in the background with encode_threads, returns the
+# futures of their encoding
+def process_unit(
+    unit: WorkUnit,
+    options: Options,
+    images: typing.List[np.array] = None
+) -> typing.List[concurrent.futures.Future]:
+    name, extension, is_skyBox, interpolate = _CHOICE_MAPPING_[unit.file_type]
+    out_dirs = output_dirs(options, unit.scan_id)
+    # stitch at the largest width, smaller ones are derived from it
+    equirect_size = [max(out_dirs.keys()), max(out_dirs.keys()) // 2]
+    out_dir = out_dirs[equirect_size[0]]
+    location = unit.location
     
-    if not(os.path.exists(out_dir)):
-        os.mkdir(out_dir)
+    for d in out_dirs.values():
+        os.makedirs(os.path.join(d, name), exist_ok=True)
 
-    if not(os.path.exists(os.path.join(out_dir, name))):
-        os.mkdir(os.path.join(out_dir, name))
+    encoding = []
+    def encode(eqr: np.array, width: int) -> None:
+        args = (eqr, out_dirs[width], name, location, options.compress_level, options.png_filter, options.color_format)
+        if options.encode_threads > 0:
+            encoding.append(encoder_pool(options.encode_threads).submit(profiling.labelled(save_panorama, *unit), *args))
+        else:
+            save_panorama(*args)
     
-    srcdir = os.path.join(base_dir, scan_id, scan_id, name)
-    filelist = sorted(os.listdir(srcdir))    
-    filedict = {}
-    for filename in filelist:
-        if not(filename.endswith(extension)):
-            continue
-        namepart, _ = os.path.splitext(filename)
-        tokens = namepart.split("_", 3)        
-        srcimg = np.array(Image.open(os.path.join(srcdir, filename)))
-        if srcimg.ndim==2:
-            srcimg = np.reshape(srcimg, (srcimg.shape[0],srcimg.shape[1],1))		
-        locationId = tokens[0]
-        if is_skyBox:
-            if not(locationId) in filedict.keys():
-                filedict[locationId] = {}
-            filedict[locationId][face_seq[len(filedict[locationId])]] = srcimg
+    if images is None:
+        images = load_unit(unit, options)
+            
+    if is_skyBox:
+        factor = 1
+        if options.scaled_decoding:
+            factor = decode_factor(name, equirect_size[0], source_format(options.m3d_path, unit.scan_id, name, extension)[0])
+        with profiling.stage("stitch"):
+            eqrar = cubemap.combine_faces(images, equirect_size, factor)
+        for width, eqr in output_sizes(eqrar, out_dirs.keys(), 'color', stitched=False):
+            encode(eqr, width)
+        return encoding
+
+    geometry = location_geometry(unit, options, equirect_size)
+    blending, is_depth = stitch_mode(name)
+    kind = panorama_kind(name)
+    if options.tile_height > 0:
+        # includes encoding, which is interleaved with stitching
+        with profiling.stage("stitch"):
+            save_panorama_tiled(images, geometry, options.tile_height, blending, is_depth, options.low_memory,
+                out_dirs, name, location, kind, options.save_lookup, options.compress_level, options.png_filter)
+        return encoding
+    with profiling.stage("stitch"):
+        eqrar = createpano.combine_views(images, geometry.v, equirect_size, blending, is_depth, geometry, options.low_memory)
+    for width, eqr in output_sizes(eqrar, out_dirs.keys(), kind):
+        encode(eqr, width)
+    if options.save_lookup and name.startswith("segmentation_maps"):
+        # source view, column and row of each label panorama pixel
+        os.makedirs(os.path.join(out_dir, "view_lookup"), exist_ok=True)
+        with profiling.stage("view_lookup"):
+            np.save(os.path.join(out_dir, "view_lookup", location + ".npy"), createpano.images_view_lookup(images, geometry))
+    return encoding
+
+# blending (color) and depth warping of the views of a type, label maps are
+# composed by nearest neighbour lookup, see createpano.combine_views
+def stitch_mode(name: str) -> typing.Tuple[bool, bool]:
+    if name == "undistorted_depth_images":
+        return False, True
+    return not(name.startswith("segmentation_maps")), False
+
+# (unit, future of its images) per unit, with the images of up to window
+# units ahead decoded in a background thread while the current one is
+# stitched. only these units are held in memory, whatever the size of a scan
+def prefetch_units(units: typing.Iterable[WorkUnit], options: Options, window: int):
+    estimates = {}
+    held = {}
+    # the units are estimated in order, so that each finds the geometry the
+    # ones before it leave
+    def estimate(unit):
+        if not(unit in estimates):
+            unit_estimate = unit_memory(unit, options, estimates)
+            estimates[unit] = unit_estimate._replace(peak=unit_estimate.peak + held_geometry(unit, unit_estimate, held))
+        return estimates[unit]
+    limit = options.max_memory - (budget.rss() or 0)
+    with concurrent.futures.ThreadPoolExecutor(1) as executor:
+        pending = collections.deque()
+        for unit in units:
+            # with a memory budget, the unit processed next and the inputs
+            # loaded meanwhile have to fit it, otherwise it is processed first
+            while options.max_memory > 0 and pending and estimate(pending[0][0]).peak + sum(
+                estimate(u).inputs for u, _ in list(pending)[1:]
+            ) + estimate(unit).inputs > limit:
+                yield pending.popleft()
+            pending.append((unit, executor.submit(load_unit, unit, options)))
+            if len(pending) > window:
+                yield pending.popleft()
+        while pending:
+            yield pending.popleft()
+
+# process_unit, with failures reported rather than raised so that they only
+# affect their own unit. returns the unit, the error (None on success) and,
+# unless waiting for it, the encoding still in progress (see finish_unit)
+def run_unit(
+    unit: WorkUnit,
+    options: Options,
+    loading: concurrent.futures.Future = None,
+    wait: bool = True
+) -> typing.Tuple[WorkUnit, typing.Optional[str], typing.List[concurrent.futures.Future]]:
+    try:
+        with profiling.labels(*unit):
+            images = None
+            if not(loading is None):
+                # time spent waiting for the prefetched inputs
+                with profiling.stage("wait_input"):
+                    images = loading.result()
+            encoding = process_unit(unit, options, images)
+        if wait:
+            finish_encoding(encoding)
+            encoding = []
+    except Exception:
+        return unit, traceback.format_exc(), []
+    return unit, None, encoding
+
+def finish_encoding(encoding: typing.List[concurrent.futures.Future]) -> None:
+    for future in encoding:
+        future.result()
+
+# error of a unit once its encoding has finished
+def finish_unit(
+    unit: WorkUnit,
+    error: typing.Optional[str],
+    encoding: typing.List[concurrent.futures.Future]
+) -> typing.Optional[str]:
+    if error is None:
+        try:
+            finish_encoding(encoding)
+        except Exception:
+            return traceback.format_exc()
+    return error
+
+# background threads encoding the panoramas of this process
+_encoder = None
+_encoder_pid = None
+
+def encoder_pool(threads: int) -> concurrent.futures.ThreadPoolExecutor:
+    global _encoder, _encoder_pid
+    # threads are not inherited by forked worker processes
+    if _encoder_pid != os.getpid():
+        _encoder = concurrent.futures.ThreadPoolExecutor(threads)
+        _encoder_pid = os.getpid()
+    return _encoder
+
+# run_unit for each of units, with the memory each needed, see budget.measured
+def run_units_measured(
+    units: typing.List[WorkUnit],
+    options: Options
+) -> typing.List[typing.Tuple[typing.Tuple[WorkUnit, typing.Optional[str], list], typing.Optional[int]]]:
+    results = []
+    for unit in units:
+        results.append(budget.measured(run_unit, unit, options))
+        budget.release_memory()
+    return results
+
+# every worker runs single threaded, parallelism comes from the processes
+def init_worker(profile: bool = False) -> None:
+    cv2.setNumThreads(1)
+    if profile:
+        profiling.enable()
+
+# memory a unit needs besides its images and panoramas, e.g. buffers of the
+# decoders and encoders, see estimate_unit_memory
+unit_overhead = 32 << 20
+
+# layers of the label lookup, i.e. views of the rig covering a panorama pixel
+# at most, see createpano.view_lookup
+lookup_layers = 4
+
+# the estimates are scaled by this to cover what they leave out, mostly the
+# memory a worker keeps after its first units (encoder threads, buffers of the
+# decoders and freed blocks the allocator holds on to), see unit_memory
+estimate_margin = 1.25
+
+# estimated memory of a work unit in bytes: its decoded source images, the
+# peak while it is processed, including them, what the process keeps cached
+# afterwards for units of its type (e.g. the skybox sampling map), and the
+# tables the geometry of its location keeps for the later types of the
+# location, as (key, bytes) with the keys of tables the types share, see
+# held_geometry
+class MemoryEstimate(typing.NamedTuple):
+    inputs: int
+    peak: int
+    cached: int = 0
+    geometry: typing.Tuple[typing.Tuple[tuple, int], ...] = ()
+
+# width, height, channels and bytes per sample of the source images of <name>
+# of a scan, which all share them, from the header of the first readable one
+@functools.lru_cache(maxsize=64)
+def source_format(m3d_path: str, scan_id: str, name: str, extension: str) -> typing.Tuple[int, int, int, int]:
+    error = None
+    for files in location_files(m3d_path, scan_id, name, extension).values():
+        for filename in files:
+            try:
+                with scanio.open_file(m3d_path, scan_id, name, filename) as f:
+                    im = Image.open(f)
+                    sample = np.array(Image.new(im.mode, (1, 1)))
+                    return im.width, im.height, sample.size, sample.itemsize
+            except (OSError, ValueError) as e:
+                error = e
+    raise FileNotFoundError(f"{scan_id}: no readable {name}") from error
+
+# panorama pixels covered by the windows of the views of a location, and by
+# the largest of them, see createpano.view_footprint
+@functools.lru_cache(maxsize=64)
+def view_windows(
+    m3d_path: str,
+    scan_id: str,
+    location: str,
+    imshape: typing.Tuple[int, int],
+    outsize: typing.Tuple[int, int],
+    camera_cache: str = None
+) -> typing.Tuple[int, int]:
+    v = load_scan_angles(m3d_path, scan_id, camera_cache)[location]
+    areas = [
+        (row1 - row0) * ncols
+        for row0, row1, _, ncols in (
+            createpano.view_footprint(imshape, createpano.default_fov, outsize[0], outsize[1], x, y) for x, y in v
+        )
+    ]
+    return sum(areas), max(areas)
+
+# temporaries of deriving the smaller widths from a stitched panorama (or
+# strip) of pixels samples of itemsize bytes, see createpano.downsample_pano:
+# its aligned copy and, for depth, a float32 copy and the validity, for
+# labels the blocks, their keys and counts
+def downsample_memory(options: Options, pixels: int, channels: int, itemsize: int, kind: str) -> int:
+    if len(options.out_widths) < 2:
+        return 0
+    size = pixels * channels * itemsize
+    if kind == 'depth':
+        size += pixels * (channels + 1) * 4
+    elif kind == 'labels':
+        size += pixels * (channels * itemsize + 8 * 2 + 4 + 1)
+    return size
+
+# memory a unit needs, from the number and header of its source images, the
+# output size and the options. it counts the buffers allocated while the unit
+# is processed: the decoded images, the stitching geometry of the location
+# (assuming the unit is the first type of the location to compute it, see
+# held_geometry for what later types find), accumulation buffers, per view intermediates and the panoramas at every
+# width, as they are held until encoded. processes need their own memory on
+# top of this
+def estimate_unit_memory(unit: WorkUnit, options: Options) -> MemoryEstimate:
+    name, extension, is_skyBox, _ = _CHOICE_MAPPING_[unit.file_type]
+    files = location_files(options.m3d_path, unit.scan_id, name, extension).get(unit.location, [])
+    if not files:
+        return MemoryEstimate(0, 0)
+    width, height, channels, itemsize = source_format(options.m3d_path, unit.scan_id, name, extension)
+    sphereW = max(options.out_widths)
+    sphereH = sphereW // 2
+    factor = 1
+    if options.scaled_decoding:
+        factor = decode_factor(name, sphereW, width)
+    imW, imH = -(-width // factor), -(-height // factor)
+    image = imW * imH * channels * itemsize
+    inputs = len(files) * image
+    # decoding a single image: PNGs are decoded at full size before reducing
+    # them, depth is corrected in float64 with a cached correction factor
+    decoding = 0
+    if factor > 1 and extension == "png":
+        decoding = width * height * channels * (itemsize + 16)
+    cached = 0
+    if options.warp_depth and name == "undistorted_depth_images":
+        decoding = max(decoding, imW * imH * channels * 8 * 2)
+        cached = imW * imH * 8
+    kind = panorama_kind(name)
+    # the panoramas at every width as they are encoded, and their samples converted for it
+    pixels = sum(w * (w // 2) for w in options.out_widths)
+    if is_skyBox:
+        # the sampling map and the transients computing it, the atlas and the panoramas
+        P = sphereW * sphereH
+        geometry = 6 * P + 24 * P + 6 * (imW + 2) ** 2 * 17
+        return MemoryEstimate(inputs, unit_overhead + inputs + geometry + 6 * (imW + 2) ** 2 * channels * itemsize
+            + pixels * channels * (itemsize + 1), 6 * P)
+    if not(options.tile_height > 0):
+        rows = sphereH
+    else:
+        rows = min(sphereH, options.tile_height)
+    P = sphereW * rows
+    imshape = createpano.cutout(np.empty((imH, imW), np.bool_), factor).shape
+    covered, largest = view_windows(options.m3d_path, unit.scan_id, unit.location, imshape,
+        (sphereW, sphereH), options.camera_cache)
+    maps = 6 if options.fixed_point else 8
+    # the geometry keeps the views unless they are computed strip by strip,
+    # and for labels the gather index of the whole panorama (and the lookup
+    # when it is saved), see createpano.PanoGeometry
+    geometry = []
+    if not(options.tile_height > 0) or not(options.store is None):
+        interpolate = (kind == 'color') if options.fixed_point else None
+        geometry.append((('views', imshape, interpolate), covered * (maps + 1)))
+    if kind == 'labels' and not(options.tile_height > 0):
+        geometry.append((('index', imshape, channels), lookup_layers * sphereW * sphereH * 4))
+        if options.save_lookup:
+            geometry.append((('lookup', imshape), lookup_layers * sphereW * sphereH * 6))
+    geometry = tuple(geometry)
+    # only the part of the views in a strip is computed for it
+    covered = covered * rows // sphereH
+    largest = largest * rows // sphereH
+    # the float64 intermediates of computing the maps of a view, see createpano.view_geometry
+    view = largest * 64
+    if kind == 'labels':
+        # nearest neighbour maps and validity, the lookup layers with their
+        # conversion to gather indices (or, once they are gathered, the
+        # smaller widths derived) and the stacked views
+        lookups = view + lookup_layers * P * (6 + 4) + 24 * P
+        if options.save_lookup:
+            lookups += lookup_layers * 6 * P
+        working = (covered * 9 + max(lookups, downsample_memory(options, P, channels, itemsize, kind))
+            + (len(files) + 1) * image + pixels * channels)
+        return MemoryEstimate(inputs, unit_overhead + inputs + cached + max(decoding, working), cached, geometry)
+    accumulate = 4 if options.low_memory else 8
+    # maps and validity of the views, the accumulated panorama and weights, the
+    # warped view with its weights (float64 whatever the accumulation) or the
+    # smaller widths derived after stitching, and the panoramas held until
+    # encoded
+    working = (covered * (maps + 1) + P * (channels + 1) * accumulate
+        + max(view, largest * ((channels + 1) * 12 + 8), downsample_memory(options, P, channels, accumulate, kind)))
+    if options.tile_height > 0:
+        working += P * channels * 2 * accumulate
+    else:
+        working += (pixels - P) * channels * accumulate + pixels * channels * itemsize
+    return MemoryEstimate(inputs, unit_overhead + inputs + cached + max(decoding, working), cached, geometry)
+
+# memory the geometry cache holds while unit is processed after the units
+# whose tables are in held, i.e. the tables of the units before it of its
+# location that it does not compute itself (see location_geometry). held maps
+# (scan, location, key) to bytes, it is updated with the tables of unit
+def held_geometry(unit: WorkUnit, estimate: MemoryEstimate, held: typing.Dict[tuple, int]) -> int:
+    location = (unit.scan_id, unit.location)
+    tables = { location + key: size for key, size in estimate.geometry }
+    if tables:
+        # the geometry of another location is replaced
+        for key in [k for k in held.keys() if k[:2] != location]:
+            del held[key]
+    size = sum(s for key, s in held.items() if not(key in tables))
+    held.update(tables)
+    return size
+
+# estimate_unit_memory with estimate_margin, or for a unit whose inputs cannot
+# be examined the largest estimate of its type in known, or the whole budget
+# without one. the unit is still processed, and fails on its own, see run_unit
+def unit_memory(
+    unit: WorkUnit,
+    options: Options,
+    known: typing.Dict[WorkUnit, MemoryEstimate]
+) -> MemoryEstimate:
+    try:
+        estimate = estimate_unit_memory(unit, options)
+        return estimate._replace(peak=int(estimate.peak * estimate_margin))
+    except Exception as e:
+        log.warning(f"{unit.scan_id} {unit.location} {unit.file_type}: memory not estimated, {e}")
+    same = [estimate for u, estimate in known.items() if u.file_type == unit.file_type]
+    if same:
+        return max(same, key=lambda estimate: estimate.peak)
+    return MemoryEstimate(0, options.max_memory)
+
+# process the units, in a pool of worker processes if one is given, otherwise
+# with the inputs of up to prefetch units decoded ahead. results are
+# collected in the order of the units (with a memory budget in a pool, in the
+# order they finish). returns the failed units
+# done is called for each unit processed successfully, in the main process
+# with options.max_memory, chunks of units are only started in the pool while
+# the estimated memory of the chunks in progress fits it, see
+# estimate_unit_memory and budget.imap_budgeted, and without a pool fewer
+# units are prefetched where needed. the estimates are then reported against
+# the memory the units were measured to need. workers is the number of
+# processes of the pool
+def process_units(
+    units: typing.List[WorkUnit],
+    options: Options,
+    pool: multiprocessing.pool.Pool = None,
+    chunksize: int = 1,
+    prefetch: int = 1,
+    done: typing.Callable[[WorkUnit], None] = None,
+    workers: int = 1
+) -> typing.List[WorkUnit]:
+    usage = budget.Usage()
+    if pool is None:
+        # encoding overlaps with stitching the next units
+        results = (
+            run_unit(unit, options, loading, wait=False)
+            for unit, loading in prefetch_units(units, options, prefetch)
+        )
+    elif options.max_memory > 0:
+        results = process_budgeted(units, options, pool, workers, chunksize, usage)
+    else:
+        if profiling.enabled:
+            # the records of the workers come back with the results
+            collected = pool.imap(functools.partial(profiling.call_collected, run_unit, options=options), units, chunksize)
+            results = map(profiling.merged, collected)
         else:
-            if not(locationId) in filedict.keys():
-                filedict[locationId] = [ srcimg ]
-            else:
-                filedict[locationId].append(srcimg)
-        
+            results = pool.imap(functools.partial(run_unit, options=options), units, chunksize)
+    failed = []
+    # units still being encoded, at most one per encoder thread
+    encoding = collections.deque()
+    def finish(unit, error, unit_encoding):
+        error = finish_unit(unit, error, unit_encoding)
+        if not(error is None):
+            log.error(f"{unit.scan_id} {unit.location} {unit.file_type} failed:\n{error}")
+            failed.append(unit)
+        elif not(done is None):
+            done(unit)
+    for result in tqdm.tqdm(results, total=len(units), desc="Dataset Progress"):
+        encoding.append(result)
+        while len(encoding) > max(1, options.encode_threads):
+            finish(*encoding.popleft())
+    while encoding:
+        finish(*encoding.popleft())
+    if options.max_memory > 0:
+        if pool is None:
+            peak = budget.peak_rss()
+            if not(peak is None):
+                log.info(f"peak memory {peak >> 20} MB of a budget of {options.max_memory >> 20} MB")
+        usage.report()
+    return failed
+
+# results of run_unit for the units, run in the pool of workers processes in
+# chunks of chunksize units within the memory budget of options.max_memory, in
+# the order the chunks finish. the memory the units needed is added to usage
+def process_budgeted(
+    units: typing.List[WorkUnit],
+    options: Options,
+    pool: multiprocessing.pool.Pool,
+    workers: int,
+    chunksize: int,
+    usage: budget.Usage
+):
+    estimates = {}
+    for unit in units:
+        estimates[unit] = unit_memory(unit, options, estimates)
+    # every worker ends up with the caches of all types
+    cached = {}
+    for unit, estimate in estimates.items():
+        cached[unit.file_type] = max(cached.get(unit.file_type, 0), estimate.cached)
+    chunks = [units[i:i + chunksize] for i in range(0, len(units), chunksize)]
+    # the units of a chunk run one after the other in a worker, and find the
+    # geometry the ones before them leave
+    peaks = {}
+    held = {}
+    for chunk in chunks:
+        held.clear()
+        for unit in chunk:
+            held_bytes = held_geometry(unit, estimates[unit], held)
+            peaks[unit] = estimates[unit].peak - estimates[unit].cached + sum(cached.values()) + held_bytes
+    chunk_estimates = [max(peaks[unit] for unit in chunk) for chunk in chunks]
+    # the workers and this process hold at least what this process holds now
+    limit = options.max_memory - (workers + 1) * (budget.rss() or 0)
+    oversized = sum(1 for e in chunk_estimates if e > limit)
+    if oversized > 0:
+        log.warning(f"{oversized} of {len(chunks)} chunks of units are estimated to exceed the memory budget "
+            f"left for units ({max(limit, 0) >> 20} MB) and are run alone")
+    if profiling.enabled:
+        fn = functools.partial(profiling.call_collected, run_units_measured, options=options)
+    else:
+        fn = functools.partial(run_units_measured, options=options)
+    collected = budget.imap_budgeted(pool, fn, chunks, chunk_estimates, limit, workers)
+    if profiling.enabled:
+        collected = map(profiling.merged, collected)
+    for chunk in collected:
+        for result, observed in chunk:
+            usage.add(result[0].file_type, peaks[result[0]], observed)
+            yield result
+
+def manifest_path(options: Options, scan_id: str) -> str:
+    out_dirs = output_dirs(options, scan_id)
+    return os.path.join(out_dirs[max(out_dirs.keys())], "manifest.json")
+
+# manifest key and entry of a unit, see manifest.Manifest. the inputs are
+# the unit's source images and, for stitched types, the camera parameters
+def unit_entry(unit: WorkUnit, options: Options, scan_manifest: manifest.Manifest) -> typing.Tuple[str, dict]:
+    name, extension, is_skyBox, _ = _CHOICE_MAPPING_[unit.file_type]
+    inputs = [(name, f) for f in location_files(options.m3d_path, unit.scan_id, name, extension)[unit.location]]
     if not is_skyBox:
-        paramdict = parse_camera_params(os.path.join(base_dir, scan_id, scan_id, "undistorted_camera_parameters", scan_id + ".conf"))
-            
-    for location in tqdm.tqdm(filedict.keys(), desc=f"{file_type}"):
-        if is_skyBox:
-            facelist = [
-                np.fliplr(filedict[location]['F']),
-                filedict[location]['R'],
-                filedict[location]['B'],
-                np.fliplr(filedict[location]['L']),
-                filedict[location]['U'],
-                np.flipud(filedict[location]['D']) 
-            ]
-            eqrar = py360convert.c2e(facelist, equirect_size[1], equirect_size[0], mode='bilinear', cube_format='list')
-            eqrar = np.fliplr(eqrar)
-            eqrimg = Image.fromarray(eqrar.astype(np.uint8))            
-            eqrimg.save(os.path.join(out_dir, name, location + ".png"))
+        inputs.append(("undistorted_camera_parameters", unit.scan_id + ".conf"))
+    signatures = [[n, f, list(scanio.file_signature(options.m3d_path, unit.scan_id, n, f))] for n, f in inputs]
+    outputs = [
+        os.path.join(d, name, unit.location + panorama_extension(name, options.color_format))
+        for d in output_dirs(options, unit.scan_id).values()
+    ]
+    if options.save_lookup and name.startswith("segmentation_maps"):
+        outputs.append(os.path.join(os.path.dirname(scan_manifest.path), "view_lookup", unit.location + ".npy"))
+    entry = {
+        'inputs': hashlib.sha1(json.dumps(signatures).encode()).hexdigest(),
+        'params': {
+            'type': unit.file_type,
+            'out_width': sorted(options.out_widths),
+            'warp_depth': bool(options.warp_depth),
+            'low_memory': options.low_memory,
+            'fixed_point': options.fixed_point,
+            'remap_quantum': None if options.store is None else options.store.quantum
+        },
+        'tool_version': tool_version,
+        'outputs': sorted(scan_manifest.relative(p) for p in outputs)
+    }
+    # only recorded when set, so that entries of earlier runs stay up to date
+    if options.scaled_decoding:
+        entry['params']['scaled_decoding'] = True
+    return unit_key(unit), entry
+
+def unit_key(unit: WorkUnit) -> str:
+    return f"{unit.file_type}/{unit.location}"
+
+# process_units for the units whose outputs are missing or stale according to
+# the manifests of their scans, or all of them with force. units are
+# recorded in the manifests as they are done, so that an interrupted run
+# resumes where it stopped. returns the failed units, done is called for the
+# units processed successfully and workers is the size of the pool as in
+# process_units
+def process_stale_units(
+    units: typing.List[WorkUnit],
+    options: Options,
+    force: bool = False,
+    pool: multiprocessing.pool.Pool = None,
+    chunksize: int = 1,
+    prefetch: int = 1,
+    done: typing.Callable[[WorkUnit], None] = None,
+    workers: int = 1
+) -> typing.List[WorkUnit]:
+    manifests = {}
+    entries = {}
+    stale = []
+    for unit in units:
+        if not(unit.scan_id in manifests):
+            manifests[unit.scan_id] = manifest.Manifest(manifest_path(options, unit.scan_id))
+        scan_manifest = manifests[unit.scan_id]
+        try:
+            entries[unit] = unit_entry(unit, options, scan_manifest)
+        except Exception as e:
+            # the unit fails on its own when it is processed and is not recorded
+            log.warning(f"{unit.scan_id} {unit.location} {unit.file_type}: no manifest entry, {e}")
+            scan_manifest.discard(unit_key(unit))
+            stale.append(unit)
+            continue
+        if force or not scan_manifest.up_to_date(*entries[unit]):
+            scan_manifest.discard(entries[unit][0])
+            stale.append(unit)
+    log.info(f"{len(units) - len(stale)} of {len(units)} work units up to date")
+    def record(unit):
+        if unit in entries:
+            manifests[unit.scan_id].record(*entries[unit])
+        if not(done is None):
+            done(unit)
+    try:
+        return process_units(stale, options, pool, chunksize, prefetch, record, workers)
+    finally:
+        for scan_manifest in manifests.values():
+            scan_manifest.save()
+
+# the stitched panorama (or a strip of it, below the rows above) at each of
+# the requested widths, see createpano.downsample_pano. skybox panoramas are
+# not stitched from views, their pixels are centred as usual
+def output_sizes(
+    eqrar: np.array,
+    widths: typing.Iterable[int],
+    kind: str,
+    stitched: bool = True,
+    above: np.array = None
+):
+    for width in sorted(widths, reverse=True):
+        if width == eqrar.shape[1]:
+            yield width, eqrar
+        else:
+            height = eqrar.shape[0] * width // eqrar.shape[1]
+            with profiling.stage("downsample"):
+                small = createpano.downsample_pano(eqrar, (width, height), kind, stitched, above)
+            yield width, small
+
+# stitch in strips of tile_height rows, which are streamed into the output
+# files, for panoramas too large to be held in memory
+def save_panorama_tiled(
+    images: typing.List[np.array],
+    geometry: createpano.PanoGeometry,
+    tile_height: int,
+    blending: bool,
+    is_depth: bool,
+    low_memory: bool,
+    out_dirs: typing.Dict[int, str],
+    name: str,
+    location: str,
+    kind: str,
+    save_lookup: bool,
+    compress_level: int = None,
+    png_filter: str = None
+) -> None:
+    out_dir = out_dirs[geometry.outsize[0]]
+    nchannels = max(im.shape[2] for im in images)
+    dtype = panorama_dtype(name)
+    if compress_level is None:
+        compress_level = default_compress_level(name)
+    with contextlib.ExitStack() as stack:
+        writers = {
+            width: stack.enter_context(pngstream.PngWriter(
+                os.path.join(d, name, location + ".png"), width, width // 2, nchannels, dtype, compress_level, png_filter
+            ))
+            for width, d in out_dirs.items()
+        }
+        lookup = None
+        on_lookup = None
+        if save_lookup and kind=='labels':
+            os.makedirs(os.path.join(out_dir, "view_lookup"), exist_ok=True)
+            lookup = np.lib.format.open_memmap(os.path.join(out_dir, "view_lookup", location + ".npy"),
+                mode='w+', dtype=np.int16, shape=(geometry.outsize[1], geometry.outsize[0], 3))
+            def on_lookup(row0, strip_lookup):
+                lookup[row0:row0 + strip_lookup.shape[0]] = strip_lookup
+        above = None
+        for row0, strip in createpano.combine_views_tiled(images, geometry.v, geometry.outsize, tile_height,
+                blending, is_depth, geometry, low_memory, on_lookup):
+            for width, eqr in output_sizes(strip, out_dirs.keys(), kind, above=above):
+                writers[width].write_rows(eqr.astype(dtype))
+            above = strip
+        if not(lookup is None):
+            lookup.flush()
+
+def panorama_dtype(name: str) -> np.dtype:
+    return np.uint16 if name=="undistorted_depth_images" else np.uint8
+
+# kind of panorama (and source image) for downsampling, see createpano.downsample_pano
+def panorama_kind(name: str) -> str:
+    if name=="undistorted_depth_images":
+        return 'depth'
+    return 'labels' if name.startswith("segmentation_maps") else 'color'
+
+# depth and label maps are stored uncompressed unless a level is chosen
+def default_compress_level(name: str) -> int:
+    if name=="undistorted_depth_images" or name.startswith("segmentation_maps"):
+        return 0
+    return 6
+
+# color panoramas may be stored as lossless WebP, everything else is PNG
+def panorama_extension(name: str, color_format: str = 'png') -> str:
+    if color_format=='webp' and not(name=="undistorted_depth_images" or name.startswith("segmentation_maps")):
+        return ".webp"
+    return ".png"
+
+# PNGs are written with pngstream, 16 bit for depth, see pngstream.PngWriter
+# for compress_level and png_filter
+def save_panorama(
+    eqrar: np.array,
+    out_dir: str,
+    name: str,
+    location: str,
+    compress_level: int = None,
+    png_filter: str = None,
+    color_format: str = 'png'
+) -> None:
+    path = os.path.join(out_dir, name, location + panorama_extension(name, color_format))
+    with profiling.stage("encode") as stage:
+        eqrar = eqrar.astype(panorama_dtype(name))
+        if path.endswith(".webp"):
+            Image.fromarray(eqrar).save(path, "WEBP", lossless=True)
         else:
-            v = createpano.get_angles(paramdict[location])
-            blending = True
-            if name.startswith("segmentation_maps"):
-                blending = False
-
-            is_depth = False
-            if name == "undistorted_depth_images":
-                is_depth = True
-                blending = False
-                if warp_depth:
-                    for i in range(len(filedict[location])):                       
-                        depth_img= correct_depth_distortion(filedict[location][i])           
-
-                        # debug code
-                        #array_buffer = depth_img.astype(np.uint16).tobytes()
-                        #eqrimg = Image.new("I", (depth_img.shape[1],depth_img.shape[0]))
-                        #eqrimg.frombytes(array_buffer, 'raw', "I;16")               
-                        #eqrimg.save(os.path.join(out_dir, name, location + "_" + str(i) + "_corrected.png"), "PNG", compress_level=0)
-
-                        
-                        filedict[location][i] = depth_img
-
-            eqrar = createpano.combine_views(filedict[location], v, equirect_size, blending, is_depth)
-            if name=="undistorted_depth_images":
-                array_buffer = eqrar.astype(np.uint16).tobytes()
-                eqrimg = Image.new("I", (eqrar.shape[1],eqrar.shape[0]))
-                eqrimg.frombytes(array_buffer, 'raw', "I;16")               
-                eqrimg.save(os.path.join(out_dir, name, location + ".png"), "PNG", compress_level=0)
-            elif name.startswith("segmentation_maps"):
-                eqrimg = Image.fromarray(eqrar.astype(np.uint8))
-                eqrimg.save(os.path.join(out_dir, name, location + ".png"), "PNG", compress_level=0)
-            else:
-                eqrimg = Image.fromarray(eqrar.astype(np.uint8))
-                eqrimg.save(os.path.join(out_dir, name, location + ".png"))
-
-def process_scan(m3d_path, out_path, scan_id, types, unpack, warp_depth) -> None:      
+            if compress_level is None:
+                compress_level = default_compress_level(name)
+            with pngstream.PngWriter(
+                path, eqrar.shape[1], eqrar.shape[0], eqrar.shape[2], eqrar.dtype, compress_level, png_filter
+            ) as writer:
+                writer.write_rows(eqrar)
+        stage.bytes = os.path.getsize(path)
+
+def unpack_scan(m3d_path: str, scan_id: str) -> None:
+    unzip(os.path.join(m3d_path,scan_id),"undistorted_camera_parameters.zip")
+    unzip(os.path.join(m3d_path,scan_id),"house_segmentations.zip")
+    unzip(os.path.join(m3d_path,scan_id),"undistorted_color_images.zip")
+    unzip(os.path.join(m3d_path,scan_id),"undistorted_depth_images.zip")
+    unzip(os.path.join(m3d_path,scan_id),"matterport_skybox_images.zip")
+
+def process_scan(
+    scan_id: str,
+    types: typing.List[str],
+    options: Options,
+    unpack: bool = False,
+    force: bool = False
+) -> typing.List[WorkUnit]:
     if unpack:
-        unzip(os.path.join(m3d_path,scan_id),"undistorted_camera_parameters.zip")
-        unzip(os.path.join(m3d_path,scan_id),"house_segmentations.zip")
-        unzip(os.path.join(m3d_path,scan_id),"undistorted_color_images.zip")
-        unzip(os.path.join(m3d_path,scan_id),"undistorted_depth_images.zip")
-        unzip(os.path.join(m3d_path,scan_id),"matterport_skybox_images.zip")
+        unpack_scan(options.m3d_path, scan_id)
+    return process_stale_units(scan_units(options.m3d_path, scan_id, types), options, force)
 
-    equirect_path = os.path.join(out_path, scan_id)
-    for t in tqdm.tqdm(types, desc="Scan Progress"):
-        args = _CHOICE_MAPPING_[t]
-        process_file_type(m3d_path, scan_id, t, args[0], equirect_path, args[1], args[2], args[3], warp_depth)
+# pack the outputs of a scan into tar shards with an index next to the scan
+# directories of every width, see shards.write_shards. shards are rewritten
+# when the manifest of the scan has changed since, or with force
+def shard_scan(scan_id: str, options: Options, shard_size: int = 0, force: bool = False) -> None:
+    folders = { t: _CHOICE_MAPPING_[t][0] for t in _CHOICE_MAPPING_ }
+    folders['view_lookup'] = "view_lookup"
+    for scan_dir in output_dirs(options, scan_id).values():
+        shard_dir = os.path.join(os.path.dirname(scan_dir), "shards")
+        if force or shards.stale(shard_dir, scan_id, manifest_path(options, scan_id)):
+            shards.write_shards(scan_dir, shard_dir, scan_id, folders, shard_size)
 
 _CHOICE_MAPPING_ = {
     # choice:   (         `folder`,             'ext'   'sky?`  `bilinear`)
@@ -210,8 +1002,8 @@ def parse_arguments(args):
     parser.add_argument("--out_path", type=str,         
         help="Output processed Matterport3D equirectangular images path"
     )
-    parser.add_argument("--out_width", type=int, 
-        default=1024, help="Output equirectangular width"
+    parser.add_argument("--out_width", type=int, nargs='+',
+        default=[1024], help="Output equirectangular width, or several widths produced from one stitching run"
     )
     parser.add_argument("--types", #type=list,
         nargs='+', default=['color'],
@@ -228,18 +1020,114 @@ def parse_arguments(args):
         help="Process all scans of the test set rather than getting list of all scans"
     )
     parser.add_argument("--unpack", action="store_true", 
-        help="Unpack ZIP files before processing"
+        help="Unpack ZIP files before processing (not required, inputs are also read from the archives directly)"
+    )
+    parser.add_argument("--remap_cache", type=str,
+        help="Directory of a remap table store shared across scans and runs"
+    )
+    parser.add_argument("--remap_cache_size", type=int, default=4096,
+        help="Maximum size of the remap table store in MB"
+    )
+    parser.add_argument("--remap_cache_quantum", type=float, default=1e-4,
+        help="Resolution in radians to which view angles are snapped for remap table lookup"
+    )
+    parser.add_argument("--camera_cache", type=str,
+        help="Directory to keep parsed camera parameters of the scans in, as binary sidecar files"
+    )
+    parser.add_argument("--low_memory", action="store_true",
+        help="Accumulate panoramas in float32 rather than float64 to reduce peak memory"
+    )
+    parser.add_argument("--save_view_lookup", action="store_true",
+        help="Save the source view, column and row of each label panorama pixel as .npy"
+    )
+    parser.add_argument("--tile_height", type=int, default=0,
+        help="Stitch in strips of this many rows, bounding memory for very large outputs (0: whole panorama)"
+    )
+    parser.add_argument("--fixed_point_maps", action="store_true",
+        help="Keep remap tables as fixed point maps, bilinear warps are quantized to 1/32 pixel"
+    )
+    parser.add_argument("--workers", type=int, default=1,
+        help="Number of worker processes, each processing one location and type at a time"
     )
-    return parser.parse_known_args(args)
+    parser.add_argument("--max_memory", type=int, default=0,
+        help="Memory budget in MB, work units are only run concurrently (or prefetched) while their estimated memory fits it (0: no limit)"
+    )
+    parser.add_argument("--prefetch", type=int, default=1,
+        help="Number of locations decoded ahead while stitching, without --workers"
+    )
+    parser.add_argument("--force", action="store_true",
+        help="Process all locations, including those the output manifest records as up to date"
+    )
+    parser.add_argument("--compress_level", type=int, choices=range(10),
+        help="PNG compression level, by default 6 for color and 0 (uncompressed) for depth and label maps"
+    )
+    parser.add_argument("--png_filter", choices=['none', 'sub', 'up', 'average', 'paeth', 'adaptive'],
+        help="PNG row filter, by default adaptive when compressing"
+    )
+    parser.add_argument("--color_format", choices=['png', 'webp'], default='png',
+        help="Format of color panoramas, webp is lossless"
+    )
+    parser.add_argument("--encode_threads", type=int, default=2,
+        help="Threads encoding panoramas while the next ones are stitched (0: encode in place)"
+    )
+    parser.add_argument("--scaled_decoding", action="store_true",
+        help="Decode source images at the reduced size the output width needs (JPEG DCT scaling, downsampling of PNGs)"
+    )
+    parser.add_argument("--profile", type=str,
+        help="Write the time spent per stage, type and location and the throughput of the run to this JSON file"
+    )
+    parser.add_argument("--shards", action="store_true",
+        help="Also pack the panoramas of each scan into tar shards with an index, in <out_path>/shards"
+    )
+    parser.add_argument("--shard_size", type=int, default=0,
+        help="Locations per shard (0: one shard per scan)"
+    )
+    parsed = parser.parse_known_args(args)
+    if parsed[0].scaled_decoding and parsed[0].save_view_lookup:
+        parser.error("--save_view_lookup refers to full size source images, which --scaled_decoding does not decode")
+    if parsed[0].tile_height > 0 and parsed[0].color_format != 'png':
+        parser.error("--tile_height writes PNG only")
+    if parsed[0].tile_height > 0:
+        # smaller widths are derived strip by strip, which needs whole pixel blocks per strip
+        largest = max(parsed[0].out_width)
+        for width in parsed[0].out_width:
+            factor = largest // width
+            if largest % width != 0 or parsed[0].tile_height % factor != 0 or (largest // 2) % factor != 0:
+                parser.error(f"--tile_height requires widths dividing {largest} with factors dividing the tile height")
+    return parsed
 
 if __name__ == "__main__":
     args, _ = parse_arguments(sys.argv)
-    equirect_size = [args.out_width, args.out_width // 2]
+    # up to date units, memory report and failures
+    logging.basicConfig(level=logging.INFO)
+    if args.profile:
+        profiling.enable()
     if not os.path.exists(args.out_path):
         os.mkdir(args.out_path)
+    store = None
+    if args.remap_cache:
+        store = remapstore.RemapStore(args.remap_cache, args.remap_cache_size << 20, args.remap_cache_quantum)
+    options = Options(
+        args.m3d_path,
+        args.out_path,
+        tuple(args.out_width),
+        args.warp_depth,
+        store,
+        args.low_memory,
+        args.save_view_lookup,
+        args.tile_height,
+        args.fixed_point_maps,
+        args.camera_cache,
+        args.compress_level,
+        args.png_filter,
+        args.color_format,
+        args.encode_threads,
+        args.scaled_decoding,
+        args.max_memory << 20
+    )
     scan_id_list = []
     if not(args.scan_id==None):
-        scan_id_list = tqdm.tqdm([args.scan_id], desc="Dataset Progress")
+        scan_id_list = [args.scan_id]
     elif args.all_test_scans:
         test_id_list = [
                          "2t7WUuJeko7",
@@ -261,8 +1149,36 @@ if __name__ == "__main__":
                          "RPmz2sHmrrY",
                          "Vt2qJdWjCF2"
         ]
-        scan_id_list = tqdm.tqdm(test_id_list, desc="Dataset Progress")
+        scan_id_list = test_id_list
     else: 
-        scan_id_list = tqdm.tqdm(os.listdir(args.m3d_path), desc="Dataset Progress")
-    for scan_id in scan_id_list:
-        process_scan(args.m3d_path, args.out_path, scan_id, args.types, args.unpack, args.warp_depth)
+        scan_id_list = sorted(os.listdir(args.m3d_path))
+    with contextlib.ExitStack() as stack:
+        pool = None
+        if args.workers > 1:
+            pool = stack.enter_context(multiprocessing.Pool(args.workers, initializer=init_worker,
+                initargs=(profiling.enabled,)))
+        if args.unpack:
+            unpack = functools.partial(unpack_scan, args.m3d_path)
+            for _ in tqdm.tqdm(map(unpack, scan_id_list) if pool is None else pool.imap(unpack, scan_id_list),
+                    total=len(scan_id_list), desc="Unpacking"):
+                pass
+        units = [unit for scan_id in scan_id_list for unit in scan_units(args.m3d_path, scan_id, args.types)]
+        # a chunk holds the types of one location, which then share its geometry
+        processed = []
+        start = time.perf_counter()
+        failed = process_stale_units(units, options, args.force, pool, len(args.types), args.prefetch,
+            processed.append, args.workers)
+        elapsed = time.perf_counter() - start
+    if args.profile:
+        profiling.write_report(args.profile, elapsed, len(processed) * len(args.out_width),
+            len(processed) * sum(w * (w // 2) for w in args.out_width) / 1e6,
+            units=len(units), processed=len(processed), failed=len(failed), workers=args.workers,
+            file_types=args.types, out_width=args.out_width)
+    if args.shards:
+        # scans with failed units are left for the rerun
+        incomplete = set(unit.scan_id for unit in failed)
+        for scan_id in tqdm.tqdm([s for s in scan_id_list if not(s in incomplete)], desc="Sharding"):
+            shard_scan(scan_id, options, args.shard_size, args.force)
+    if failed:
+        log.error(f"{len(failed)} of {len(units)} work units failed")
+        sys.exit(1)
@@ -0,0 +1,174 @@
+# Created 2020 by JOANNEUM RESEARCH as part of the ATLANTIS H2020 project
+# https://www.joanneum.at
+# http://www.atlantis-ar.eu
+#
+# This tool is part of a project that has received funding from the European
+# Union's Horizon 2020 research and innovation programme under grant
+# agreement No 951900.
+
+# optional timing of the stages of the panorama pipeline
+#
+# stages are timed with
+#     with profiling.stage("remap") as s:
+#         ...
+#         s.bytes = n
+# and recorded with their wall and CPU time (of the calling thread) and the
+# bytes they handled, under the labels (scan, location, type) set for the
+# thread with profiling.labels. stages may nest, e.g. remap within stitch,
+# the times of each are inclusive. unless enabled, stage returns a shared
+# object that does nothing, so instrumented code costs next to nothing.
+# records of worker processes are passed back with their results, see
+# call_collected and merged.
+
+import json
+import os
+import threading
+import time
+import typing
+import contextlib
+import logging
+
+log = logging.getLogger(__name__)
+
+enabled = False
+
+# [count, wall, cpu, bytes] by (stage, scan, location, type)
+_records = {}
+_lock = threading.Lock()
+_local = threading.local()
+
+def enable() -> None:
+    global enabled
+    enabled = True
+
+class _Stage:
+    def __init__(self, name: str):
+        self.name = name
+        self.bytes = 0
+
+    def __enter__(self):
+        self.wall = time.perf_counter()
+        self.cpu = time.thread_time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        record(
+            self.name,
+            time.perf_counter() - self.wall,
+            time.thread_time() - self.cpu,
+            self.bytes
+        )
+
+class _NoStage:
+    bytes = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+_no_stage = _NoStage()
+
+def stage(name: str):
+    if not enabled:
+        return _no_stage
+    return _Stage(name)
+
+def record(name: str, wall: float, cpu: float, nbytes: int = 0) -> None:
+    key = (name,) + getattr(_local, 'labels', ('', '', ''))
+    with _lock:
+        entry = _records.setdefault(key, [0, 0.0, 0.0, 0])
+        entry[0] += 1
+        entry[1] += wall
+        entry[2] += cpu
+        entry[3] += nbytes
+
+# label the stages of this thread with scan, location and type
+@contextlib.contextmanager
+def labels(scan_id: str, location: str, file_type: str):
+    if not enabled:
+        yield
+        return
+    previous = getattr(_local, 'labels', None)
+    _local.labels = (scan_id, location, file_type)
+    try:
+        yield
+    finally:
+        if previous is None:
+            del _local.labels
+        else:
+            _local.labels = previous
+
+# fn with its stages labelled, for running it in another thread
+def labelled(fn: typing.Callable, scan_id: str, location: str, file_type: str) -> typing.Callable:
+    if not enabled:
+        return fn
+    def run(*args, **kwargs):
+        with labels(scan_id, location, file_type):
+            return fn(*args, **kwargs)
+    return run
+
+# records of this process since the last call
+def take() -> dict:
+    global _records
+    with _lock:
+        records, _records = _records, {}
+    return records
+
+def merge(records: dict) -> None:
+    for key, (count, wall, cpu, nbytes) in records.items():
+        with _lock:
+            entry = _records.setdefault(key, [0, 0.0, 0.0, 0])
+            entry[0] += count
+            entry[1] += wall
+            entry[2] += cpu
+            entry[3] += nbytes
+
+# fn(*args, **kwargs) together with the records of this process, for calling
+# it in a worker process, see merged
+def call_collected(fn: typing.Callable, *args, **kwargs):
+    result = fn(*args, **kwargs)
+    return result, take()
+
+# the result of call_collected, with its records merged into this process
+def merged(collected):
+    result, records = collected
+    merge(records)
+    return result
+
+def _add(totals: dict, key: str, entry: typing.List) -> None:
+    total = totals.setdefault(key, { 'count': 0, 'wall': 0.0, 'cpu': 0.0, 'bytes': 0 })
+    total['count'] += entry[0]
+    total['wall'] += entry[1]
+    total['cpu'] += entry[2]
+    total['bytes'] += entry[3]
+
+# totals per stage, per type and stage and per location, type and stage,
+# together with the throughput of the run
+def summary(elapsed: float, panoramas: int, megapixels: float, **info) -> dict:
+    stages, types, locations = {}, {}, {}
+    with _lock:
+        for (name, scan_id, location, file_type), entry in _records.items():
+            _add(stages, name, entry)
+            _add(types.setdefault(file_type, {}), name, entry)
+            _add(locations.setdefault(f"{scan_id}/{location}", {}).setdefault(file_type, {}), name, entry)
+    return dict(info,
+        elapsed=elapsed,
+        panoramas=panoramas,
+        megapixels=megapixels,
+        panoramas_per_s=panoramas / elapsed if elapsed > 0 else 0.0,
+        megapixels_per_s=megapixels / elapsed if elapsed > 0 else 0.0,
+        stages=stages,
+        types=types,
+        locations=locations
+    )
+
+def write_report(path: str, elapsed: float, panoramas: int, megapixels: float, **info) -> None:
+    report = summary(elapsed, panoramas, megapixels, **info)
+    tmppath = f"{path}.{os.getpid()}.tmp"
+    with open(tmppath, 'w') as f:
+        json.dump(report, f, indent=1, sort_keys=True)
+    os.replace(tmppath, path)
+    log.info(f"{panoramas} panoramas in {elapsed:.1f} s, {report['panoramas_per_s']:.2f} panoramas/s, "
+        f"{report['megapixels_per_s']:.2f} MP/s")
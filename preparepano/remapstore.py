@@ -0,0 +1,105 @@
+# Created 2020 by JOANNEUM RESEARCH as part of the ATLANTIS H2020 project
+# https://www.joanneum.at
+# http://www.atlantis-ar.eu
+#
+# This tool is part of a project that has received funding from the European
+# Union's Horizon 2020 research and innovation programme under grant
+# agreement No 951900.
+
+# persistent store of remap tables, shared by all scans and worker processes
+#
+# every entry is a directory of .npy files that is written to a temporary
+# name and renamed into place, so readers never see partial entries. entries
+# are loaded memory mapped, and the least recently used ones are removed once
+# the store grows beyond its size limit.
+
+import hashlib
+import os
+import shutil
+import time
+import typing
+import uuid
+import numpy as np
+import logging
+
+log = logging.getLogger(__name__)
+
+# bump when the layout or meaning of stored tables changes
+store_version = 4
+# temporary entries older than this are leftovers of crashed writers
+stale_seconds = 3600
+
+class RemapStore:
+    def __init__(self, root: str, max_bytes: int = 4 << 30, quantum: float = 1e-4):
+        self.root = root
+        self.max_bytes = max_bytes
+        # resolution in radians to which view angles are snapped for lookup
+        self.quantum = quantum
+        os.makedirs(root, exist_ok=True)
+
+    def quantize(self, angle: float) -> float:
+        return round(angle / self.quantum) * self.quantum
+
+    def key(self, *params) -> str:
+        return hashlib.sha1(repr((store_version,) + params).encode()).hexdigest()
+
+    def get(self, key: str) -> typing.Optional[typing.Dict[str, np.array]]:
+        path = os.path.join(self.root, key)
+        try:
+            arrays = {
+                os.path.splitext(f)[0]: np.load(os.path.join(path, f), mmap_mode='r')
+                for f in os.listdir(path) if f.endswith('.npy')
+            }
+            # mark as recently used for eviction
+            os.utime(path)
+        except (FileNotFoundError, NotADirectoryError):
+            # not there, or evicted by another process meanwhile
+            return None
+        return arrays
+
+    def put(self, key: str, arrays: typing.Dict[str, np.array]) -> typing.Dict[str, np.array]:
+        path = os.path.join(self.root, key)
+        tmppath = os.path.join(self.root, f".tmp-{uuid.uuid4().hex}")
+        os.mkdir(tmppath)
+        for name, a in arrays.items():
+            np.save(os.path.join(tmppath, name + '.npy'), a)
+        try:
+            os.rename(tmppath, path)
+        except OSError:
+            # another process stored the same entry first
+            shutil.rmtree(tmppath, ignore_errors=True)
+        self.evict()
+        stored = self.get(key)
+        return arrays if stored is None else stored
+
+    def evict(self) -> None:
+        entries = []
+        total = 0
+        for entry in os.scandir(self.root):
+            if entry.name.startswith('.'):
+                try:
+                    if time.time() - entry.stat().st_mtime > stale_seconds:
+                        shutil.rmtree(entry.path, ignore_errors=True)
+                except FileNotFoundError:
+                    pass
+                continue
+            if not entry.is_dir():
+                continue
+            try:
+                size = sum(f.stat().st_size for f in os.scandir(entry.path))
+                entries.append((entry.stat().st_mtime, size, entry.path))
+            except FileNotFoundError:
+                continue
+            total += size
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            # move out of the way first so that readers never see a partial entry
+            trashpath = os.path.join(self.root, f".del-{uuid.uuid4().hex}")
+            try:
+                os.rename(path, trashpath)
+            except OSError:
+                continue
+            shutil.rmtree(trashpath, ignore_errors=True)
+            total -= size
+            log.debug(f"evicted remap table {os.path.basename(path)}")
@@ -0,0 +1,107 @@
+# Created 2020 by JOANNEUM RESEARCH as part of the ATLANTIS H2020 project
+# https://www.joanneum.at
+# http://www.atlantis-ar.eu
+#
+# This tool is part of a project that has received funding from the European
+# Union's Horizon 2020 research and innovation programme under grant
+# agreement No 951900.
+
+# access to the files of a Matterport scan, either extracted or straight out
+# of the scan's ZIP archives
+#
+# the files of <name> (e.g. undistorted_color_images) are read from the
+# directory <m3d_path>/<scan>/<scan>/<name> if it exists, which is where
+# extracting the archives puts them, otherwise from the archive
+# <m3d_path>/<scan>/<name>.zip with members <scan>/<name>/<file>.
+# archives are opened once per process, so this can be used from forked
+# worker processes as well, and are shared by its threads.
+
+import io
+import os
+import typing
+import zipfile
+import collections
+import threading
+import logging
+
+log = logging.getLogger(__name__)
+
+# archives kept open per process
+max_open_archives = 16
+
+# open archives with the names of their members, by path, of process _pid
+_archives = collections.OrderedDict()
+_pid = None
+# guards _archives, and reads from an archive so that it is not closed meanwhile
+_lock = threading.RLock()
+
+def _reset_lock() -> None:
+    global _lock
+    _lock = threading.RLock()
+
+# a thread of the parent process may have held the lock while forking
+os.register_at_fork(after_in_child=_reset_lock)
+
+def _archive(path: str) -> typing.Tuple[zipfile.ZipFile, typing.Dict[str, zipfile.ZipInfo]]:
+    global _pid
+    with _lock:
+        # handles inherited from the parent process share its file offsets
+        if _pid != os.getpid():
+            _archives.clear()
+            _pid = os.getpid()
+        if path in _archives:
+            _archives.move_to_end(path)
+        else:
+            archive = zipfile.ZipFile(path, 'r')
+            _archives[path] = (archive, { info.filename: info for info in archive.infolist() })
+            if len(_archives) > max_open_archives:
+                _, (oldest, _) = _archives.popitem(last=False)
+                oldest.close()
+        return _archives[path]
+
+def _directory(m3d_path: str, scan_id: str, name: str) -> str:
+    return os.path.join(m3d_path, scan_id, scan_id, name)
+
+def _archive_path(m3d_path: str, scan_id: str, name: str) -> str:
+    return os.path.join(m3d_path, scan_id, name + ".zip")
+
+# file names of <name> of a scan, raises FileNotFoundError if there is
+# neither a directory nor an archive
+def list_files(m3d_path: str, scan_id: str, name: str) -> typing.List[str]:
+    directory = _directory(m3d_path, scan_id, name)
+    if os.path.isdir(directory):
+        return os.listdir(directory)
+    path = _archive_path(m3d_path, scan_id, name)
+    if not(os.path.exists(path)):
+        raise FileNotFoundError(f"neither {directory} nor {path} exist")
+    prefix = f"{scan_id}/{name}/"
+    _, members = _archive(path)
+    return [
+        member[len(prefix):] for member in members
+        if member.startswith(prefix) and len(member) > len(prefix) and not member.endswith('/')
+    ]
+
+# contents of a file of <name> of a scan as a binary file object
+def open_file(m3d_path: str, scan_id: str, name: str, filename: str) -> typing.BinaryIO:
+    directory = _directory(m3d_path, scan_id, name)
+    if os.path.isdir(directory):
+        return open(os.path.join(directory, filename), 'rb')
+    path = _archive_path(m3d_path, scan_id, name)
+    with _lock:
+        archive, members = _archive(path)
+        member = f"{scan_id}/{name}/{filename}"
+        if not(member in members):
+            raise FileNotFoundError(f"{member} not in {path}")
+        # read completely, as decoders seek, which is slow on compressed members
+        return io.BytesIO(archive.read(members[member]))
+
+# size and modification time (extracted) or size and CRC (archive) of a file,
+# which change with its contents
+def file_signature(m3d_path: str, scan_id: str, name: str, filename: str) -> typing.Tuple[int, int]:
+    directory = _directory(m3d_path, scan_id, name)
+    if os.path.isdir(directory):
+        st = os.stat(os.path.join(directory, filename))
+        return (st.st_size, st.st_mtime_ns)
+    _, members = _archive(_archive_path(m3d_path, scan_id, name))
+    info = members[f"{scan_id}/{name}/{filename}"]
+    return (info.file_size, info.CRC)
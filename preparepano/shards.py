@@ -0,0 +1,144 @@
+# Created 2020 by JOANNEUM RESEARCH as part of the ATLANTIS H2020 project
+# https://www.joanneum.at
+# http://www.atlantis-ar.eu
+#
+# This tool is part of a project that has received funding from the European
+# Union's Horizon 2020 research and innovation programme under grant
+# agreement No 951900.
+
+# sharded output for training: the panoramas of a scan packed into a few
+# uncompressed tar files, with an index of where each location is
+#
+# members are named <location>.<type>.<ext> (as in WebDataset) and the
+# members of a location are stored one after the other, so that a reader gets
+# all types of a location with a single seek and read, see ShardReader.
+# shards and index are written to temporary names and renamed into place.
+
+import io
+import json
+import os
+import tarfile
+import typing
+import numpy as np
+from PIL import Image
+import logging
+
+log = logging.getLogger(__name__)
+
+# bump when the layout of the index changes
+index_version = 1
+
+def index_path(shard_dir: str, scan_id: str) -> str:
+    return os.path.join(shard_dir, scan_id + ".index.json")
+
+# output files per location and type, for folders {type: folder} of scan_dir
+def scan_members(scan_dir: str, folders: typing.Dict[str, str]) -> typing.Dict[str, typing.Dict[str, str]]:
+    locations = {}
+    for key, folder in folders.items():
+        if not(os.path.isdir(os.path.join(scan_dir, folder))):
+            continue
+        for filename in sorted(os.listdir(os.path.join(scan_dir, folder))):
+            location, ext = os.path.splitext(filename)
+            if ext in (".png", ".webp", ".npy"):
+                locations.setdefault(location, {})[key] = os.path.join(scan_dir, folder, filename)
+    return locations
+
+# the index is older than the given file (e.g. the manifest of the scan)
+def stale(shard_dir: str, scan_id: str, reference: str) -> bool:
+    try:
+        return os.path.getmtime(index_path(shard_dir, scan_id)) < os.path.getmtime(reference)
+    except FileNotFoundError:
+        return True
+
+# pack the outputs of a scan into shards of shard_size locations (0: a single
+# shard), returns the index path
+def write_shards(
+    scan_dir: str,
+    shard_dir: str,
+    scan_id: str,
+    folders: typing.Dict[str, str],
+    shard_size: int = 0
+) -> str:
+    os.makedirs(shard_dir, exist_ok=True)
+    members = scan_members(scan_dir, folders)
+    locations = sorted(members.keys())
+    if shard_size <= 0:
+        shard_size = max(1, len(locations))
+    index = { 'version': index_version, 'scan': scan_id, 'shards': [], 'locations': {} }
+    for first in range(0, len(locations), shard_size):
+        shard = f"{scan_id}-{first // shard_size:05d}.tar"
+        path = os.path.join(shard_dir, shard)
+        tmppath = f"{path}.{os.getpid()}.tmp"
+        with tarfile.open(tmppath, 'w', format=tarfile.GNU_FORMAT) as tar:
+            for location in locations[first:first + shard_size]:
+                for key, filename in sorted(members[location].items()):
+                    tar.add(filename, f"{location}.{key}{os.path.splitext(filename)[1]}", recursive=False)
+        # offsets of the data of every member
+        with tarfile.open(tmppath, 'r') as tar:
+            for info in tar:
+                location, key, ext = info.name.split(".")
+                entry = index['locations'].setdefault(location, { 'shard': len(index['shards']), 'members': {} })
+                entry['members'][key] = [info.offset_data, info.size, ext]
+        os.replace(tmppath, path)
+        index['shards'].append(shard)
+    # span from the first to the end of the last member of each location
+    for entry in index['locations'].values():
+        spans = entry['members'].values()
+        entry['offset'] = min(m[0] for m in spans)
+        entry['size'] = max(m[0] + m[1] for m in spans) - entry['offset']
+    path = index_path(shard_dir, scan_id)
+    with open(f"{path}.{os.getpid()}.tmp", 'w') as f:
+        json.dump(index, f, indent=1, sort_keys=True)
+    os.replace(f"{path}.{os.getpid()}.tmp", path)
+    log.debug(f"{scan_id}: {len(locations)} locations in {len(index['shards'])} shards")
+    return path
+
+def decode_member(data: bytes, ext: str) -> np.array:
+    if ext == "npy":
+        return np.load(io.BytesIO(data))
+    return np.array(Image.open(io.BytesIO(data)))
+
+# read access to the shards of a scan through their index
+class ShardReader:
+    def __init__(self, path: str):
+        with open(path, 'r') as f:
+            self.index = json.load(f)
+        if self.index.get('version') != index_version:
+            raise ValueError(f"{path}: unsupported shard index version")
+        self.shard_dir = os.path.dirname(path)
+        self._files = {}
+
+    def locations(self) -> typing.List[str]:
+        return sorted(self.index['locations'].keys())
+
+    # encoded files of a location by type
+    def read(self, location: str, types: typing.Iterable[str] = None) -> typing.Dict[str, typing.Tuple[bytes, str]]:
+        entry = self.index['locations'][location]
+        f = self._file(entry['shard'])
+        f.seek(entry['offset'])
+        data = f.read(entry['size'])
+        return {
+            key: (data[offset - entry['offset']:offset - entry['offset'] + size], ext)
+            for key, (offset, size, ext) in entry['members'].items()
+            if types is None or key in types
+        }
+
+    # decoded panoramas of a location by type
+    def load(self, location: str, types: typing.Iterable[str] = None) -> typing.Dict[str, np.array]:
+        return { key: decode_member(data, ext) for key, (data, ext) in self.read(location, types).items() }
+
+    def close(self) -> None:
+        for f in self._files.values():
+            f.close()
+        self._files = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _file(self, shard: int) -> typing.BinaryIO:
+        if not(shard in self._files):
+            self._files[shard] = open(os.path.join(self.shard_dir, self.index['shards'][shard]), 'rb')
+        return self._files[shard]
@@ -0,0 +1,60 @@
+# Created 2020 by JOANNEUM RESEARCH as part of the ATLANTIS H2020 project
+# https://www.joanneum.at
+# http://www.atlantis-ar.eu
+#
+# This tool is part of a project that has received funding from the European
+# Union's Horizon 2020 research and innovation programme under grant
+# agreement No 951900.
+
+# run with pytest from this directory
+
+import numpy as np
+import pytest
+import createpano
+
+# valid pixels of a view on the whole panorama, computed without a footprint
+def full_valid(monkeypatch, imshape, sphereW, x, y) -> np.array:
+    with monkeypatch.context() as m:
+        m.setattr(createpano, "view_footprint", lambda *args: (0, sphereW // 2, 0, sphereW))
+        return createpano.view_geometry(imshape, createpano.default_fov, sphereW, sphereW // 2, x, y).valid
+
+# valid pixels of a view outside of its footprint
+def missed_pixels(monkeypatch, imshape, sphereW, x, y) -> int:
+    row0, row1, col0, ncols = createpano.view_footprint(imshape, createpano.default_fov, sphereW, sphereW // 2, x, y)
+    inside = np.zeros((sphereW // 2, sphereW), np.bool_)
+    inside[row0:row1, np.mod(np.arange(col0, col0 + ncols), sphereW)] = True
+    return int(np.count_nonzero(full_valid(monkeypatch, imshape, sphereW, x, y) & ~inside))
+
+@pytest.mark.parametrize("imshape, sphereW, x, y", [
+    # rig views
+    ((1013, 1254), 512, 0.0, 0.0),
+    ((1013, 1254), 512, 3.1, 0.5),
+    ((1013, 1254), 512, -2.0, -0.5),
+    # a pole inside the view
+    ((400, 500), 256, 1.0, 1.5),
+    ((400, 500), 256, -1.0, -1.5),
+    # the border passes close to a pole without containing it
+    ((125, 457), 256, 1.458, 1.41),
+])
+def test_view_footprint_contains_view(monkeypatch, imshape, sphereW, x, y):
+    assert missed_pixels(monkeypatch, imshape, sphereW, x, y) == 0
+
+def test_view_footprint_contains_random_views(monkeypatch):
+    rng = np.random.default_rng(1)
+    for _ in range(400):
+        imshape = (int(rng.integers(20, 300)), int(rng.integers(20, 500)))
+        sphereW = int(rng.choice([64, 128, 256]))
+        x, y = rng.uniform(-np.pi, np.pi), rng.uniform(-1.55, 1.55)
+        assert missed_pixels(monkeypatch, imshape, sphereW, x, y) == 0, (imshape, sphereW, x, y)
+
+# views of reduced source images sample where the full size views do
+@pytest.mark.parametrize("factor", [2, 4, 8])
+def test_scaled_view_matches_full_size(factor):
+    full = createpano.view_geometry(createpano.cutout_shape(), createpano.default_fov, 512, 256, 0.3, 0.1)
+    scaled = createpano.view_geometry(createpano.cutout_shape(factor), createpano.default_fov, 512, 256, 0.3, 0.1)
+    valid = full.valid & scaled.valid
+    assert np.count_nonzero(valid) > 0.9 * np.count_nonzero(full.valid)
+    for maps, offset in ((full.mapx, scaled.mapx), createpano.imcutout[1][0]), ((full.mapy, scaled.mapy), createpano.imcutout[0][0]):
+        # the maps sample pixel map + 1 of the cutout
+        expected = (maps[0] + 1 + offset - (factor - 1) / 2) / factor - offset // factor - 1
+        np.testing.assert_allclose(maps[1][valid], expected[valid], atol=1e-3)